@@ -0,0 +1,119 @@
+import      math
+
+def coarse_indices(n, stride):
+    """ Indices of a coarse grid along an axis, always including both ends """
+    idx = range(0, n, stride)
+    if idx[-1] != n - 1:
+        idx.append(n - 1)
+    return idx
+
+class AdaptiveGrid:
+    """ Refine a two-dimensional grid of experiments where the success rate or the identity changes sharply or is uncertain """
+    def __init__(self, xs, ys, max_reps, init_reps=2, stride=8, min_grad=0.2):
+        if max_reps < 1 or init_reps < 1 or stride < 1:
+            raise ValueError("The replicate numbers and the stride must be positive!")
+        self.xs         = list(xs)
+        self.ys         = list(ys)
+        self.x_idx      = dict( (x, i) for i, x in enumerate(self.xs) )
+        self.y_idx      = dict( (y, j) for j, y in enumerate(self.ys) )
+        self.max_reps   = max_reps
+        self.init_reps  = min(init_reps, max_reps)
+        self.stride     = stride
+        self.min_grad   = min_grad
+        # Planned replicates and results of the cells, keyed by grid indices:
+        self.reps       = { }
+        self.results    = { }
+
+    def _plan(self, cell, n):
+        """ Plan up to n more replicates of a cell, return them as (x, y, rep) """
+        done    = self.reps.get(cell, 0)
+        n       = min(n, self.max_reps - done)
+        if n <= 0:
+            return [ ]
+        self.reps[cell] = done + n
+        i, j    = cell
+        return [ (self.xs[i], self.ys[j], rep) for rep in xrange(done, done + n) ]
+
+    def initial(self):
+        """ Plan the replicates of the coarse grid missing from earlier runs """
+        res = [ ]
+        for i in coarse_indices(len(self.xs), self.stride):
+            for j in coarse_indices(len(self.ys), self.stride):
+                res.extend(self._plan((i, j), self.init_reps - self.reps.get((i, j), 0)))
+        return res
+
+    def add_result(self, x, y, rep, status, seq_ident):
+        """ Record the result of an experiment, results of earlier runs count as planned """
+        cell    = (self.x_idx[x], self.y_idx[y])
+        self.results.setdefault(cell, { })[rep] = (status, seq_ident)
+        self.reps[cell] = max(self.reps.get(cell, 0), rep + 1)
+
+    def nr_planned(self):
+        """ Number of planned experiments """
+        return sum(self.reps.itervalues())
+
+    def stats(self, cell):
+        """ Success rate, mean identity of the successful experiments (None without any) and their uncertainty """
+        res     = self.results[cell].values()
+        n       = len(res)
+        idents  = [ ident for status, ident in res if status == 0 ]
+        p       = len(idents) / float(n)
+        # Shrink the success rate towards 1/2, so unanimous cells with few replicates stay uncertain:
+        ps      = (len(idents) + 1.0) / (n + 2.0)
+        err     = math.sqrt(ps * (1.0 - ps) / (n + 2.0))
+        ident   = None
+        if len(idents) > 0:
+            ident   = sum(idents) / len(idents)
+        if len(idents) > 1:
+            var     = sum( (v - ident)**2 for v in idents ) / (len(idents) - 1)
+            err     += math.sqrt(var / len(idents)) / 100.0
+        return p, ident, err
+
+    def _gradient(self, a, b):
+        """ Difference of the success rates and the identities of two cells """
+        pa, ia, _   = self.stats(a)
+        pb, ib, _   = self.stats(b)
+        res         = abs(pa - pb)
+        if ia is not None and ib is not None:
+            res     += abs(ia - ib) / 100.0
+        return res
+
+    def _edges(self):
+        """ Pairs of neighbouring cells with results and grid points between them """
+        rows    = { }
+        cols    = { }
+        for i, j in self.results.iterkeys():
+            rows.setdefault(i, [ ]).append(j)
+            cols.setdefault(j, [ ]).append(i)
+        for i, js in rows.iteritems():
+            js.sort()
+            for j1, j2 in zip(js[:-1], js[1:]):
+                if j2 - j1 > 1:
+                    yield (i, j1), (i, j2), (i, (j1 + j2) // 2)
+        for j, is_ in cols.iteritems():
+            is_.sort()
+            for i1, i2 in zip(is_[:-1], is_[1:]):
+                if i2 - i1 > 1:
+                    yield (i1, j), (i2, j), ((i1 + i2) // 2, j)
+
+    def propose(self, n):
+        """ Plan up to n experiments: new cells between neighbours differing sharply, then replicates of uncertain cells """
+        new_cells   = { }
+        for a, b, mid in self._edges():
+            if mid in self.reps:
+                continue
+            grad    = self._gradient(a, b)
+            if grad >= self.min_grad:
+                new_cells[mid]  = max(grad, new_cells.get(mid, 0.0))
+        uncertain   = [ (self.stats(cell)[2], cell) for cell in self.results.iterkeys() if self.reps[cell] < self.max_reps ]
+        res         = [ ]
+        # The steepest edges first, then the most uncertain cells:
+        for grad, cell in sorted(( (g, c) for c, g in new_cells.iteritems() ), reverse=True):
+            if len(res) >= n:
+                return res
+            res.extend(self._plan(cell, min(self.init_reps, n - len(res))))
+        for err, cell in sorted(uncertain, reverse=True):
+            if len(res) >= n:
+                break
+            res.extend(self._plan(cell, 1))
+        return res
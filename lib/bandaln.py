@@ -0,0 +1,171 @@
+import      utils       as      u
+import      numpy       as      np
+
+# A score low enough to never be part of an alignment:
+NEG_INF = -10**9
+
+class BandAligner:
+    """ Banded affine local alignment of two similar sequences """
+    def __init__(self, log, match=5, mismatch=-4, gap_open=-100, gap_extend=-100, k=12, min_band=32, max_kmer_hits=200, fallback=None):
+        self.log            = log
+        self.fallback       = fallback
+        self.match          = match
+        self.mismatch       = mismatch
+        self.gap_open       = gap_open
+        self.gap_extend     = gap_extend
+        self.k              = k
+        self.min_band       = min_band
+        self.max_kmer_hits  = max_kmer_hits
+        if gap_open > gap_extend:
+            raise ValueError("Gap opening must not be cheaper than gap extension!")
+
+    def seq_cmp(self, s1, s2):
+        """ Compare two sequences by pairwise alignment, in the format of Exonerate.seq_cmp """
+        if len(s1) == 0 or len(s2) == 0:
+            return None
+        c1, c2  = encode(s1), encode(s2)
+        diag    = seed_diagonal(c1, c2, self.k, self.max_kmer_hits)
+        width   = self.min_band
+        # Sequences without shared k-mers are compared by the fallback aligner, or without a band:
+        if diag is None:
+            if self.fallback is not None:
+                return self.fallback.seq_cmp(s1, s2)
+            diag, width = 0, max(len(s1), len(s2))
+        # Widen the band until the best alignment does not touch its edges:
+        while True:
+            lo, hi  = diag - width, diag + width
+            res     = self._align(c1, c2, lo, hi)
+            full    = lo <= -len(s1) and hi >= len(s2)
+            if res is None or not res['edge'] or full:
+                break
+            width   *= 2
+        if res is None or res['columns'] == 0:
+            return None
+        return {
+            'percent_identity':     round(100.0 * res['matches'] / res['columns'], 2),
+            'alignment_length':     res['end'] - res['start'],
+        }
+
+    def _align(self, c1, c2, lo, hi):
+        """ Local alignment restricted to diagonals lo <= j - i <= hi """
+        n, m        = len(c1), len(c2)
+        lo, hi      = max(lo, -n), min(hi, m)
+        width       = hi - lo + 1
+        go, ge      = self.gap_open, self.gap_extend
+        ks          = np.arange(width)
+        # Row i = 0: every cell is a possible local alignment start.
+        H_prev      = np.zeros(width + 1, dtype=np.int64)
+        F_prev      = np.zeros(width + 1, dtype=np.int64) + NEG_INF
+        # Per-cell statistics of the best path: matches, columns, start on s1, band edge touched.
+        Hs_prev     = np.zeros((4, width + 1), dtype=np.int64)
+        Fs_prev     = np.zeros((4, width + 1), dtype=np.int64)
+        best        = { 'score': 0, 'columns': 0, 'matches': 0, 'start': 0, 'end': 0, 'edge': False }
+
+        for i in xrange(1, n + 1):
+            j       = i + lo + ks
+            valid   = (j >= 1) & (j <= m)
+            edge    = ((ks == 0) & (lo > -n)) | ((ks == width - 1) & (hi < m))
+            # Match/mismatch scores along the row:
+            jj      = np.clip(j - 1, 0, m - 1)
+            same    = (c2[jj] == c1[i-1]) & (c1[i-1] >= 0)
+            diag    = H_prev[:width] + np.where(same, self.match, self.mismatch)
+            # Vertical gaps from the previous row (cell k+1 in diagonal coordinates):
+            f_open  = H_prev[1:] + go
+            f_ext   = F_prev[1:] + ge
+            F       = np.maximum(f_open, f_ext)
+            # Best of restart, diagonal step and vertical gap:
+            H0      = np.maximum(np.maximum(diag, F), 0)
+            H0[~valid]  = NEG_INF
+            H0[j == 0]  = 0     # Left matrix border, where local alignments start.
+            F[~valid]   = NEG_INF
+            # Statistics of the vertical gap and diagonal paths:
+            Fs      = np.where(f_open >= f_ext, Hs_prev[:, 1:], Fs_prev[:, 1:])
+            Fs      = Fs + np.array([0, 1, 0, 0])[:, np.newaxis]
+            Ds      = Hs_prev[:, :width] + np.array([same, np.ones(width), np.zeros(width), np.zeros(width)], dtype=np.int64)
+            Hs      = np.where(diag >= F, Ds, Fs)
+            restart = (H0 == 0)
+            Hs[:, restart]  = np.array([0, 0, i, 0])[:, np.newaxis]
+            # Horizontal gaps by a running maximum over the row:
+            src     = H0 + go - (ks + 1) * ge
+            run     = np.maximum.accumulate(src)
+            E       = np.zeros(width, dtype=np.int64) + NEG_INF
+            E[1:]   = run[:-1] + ks[1:] * ge
+            idx     = np.where(src >= run, ks, 0)
+            idx     = np.maximum.accumulate(idx)
+            use_e   = (E > H0) & valid
+            H       = np.where(use_e, E, H0)
+            if np.any(use_e):
+                from_k          = idx[np.maximum(ks - 1, 0)]
+                Es              = Hs[:, from_k] + np.array([0, 1, 0, 0])[:, np.newaxis] * (ks - from_k)
+                Hs[:, use_e]    = Es[:, use_e]
+            Hs[3]   = Hs[3] | edge
+            # Keep the best cell:
+            top     = np.argmax(H)
+            if H[top] > best['score']:
+                best    = {
+                    'score':    int(H[top]),
+                    'matches':  int(Hs[0, top]),
+                    'columns':  int(Hs[1, top]),
+                    'start':    int(Hs[2, top]),
+                    'end':      i,
+                    'edge':     bool(Hs[3, top]),
+                }
+            # Shift to the next row, padding the band on the right:
+            H_prev[:width]  = H
+            H_prev[width]   = NEG_INF
+            F_prev[:width]  = F
+            F_prev[width]   = NEG_INF
+            Hs_prev[:, :width]  = Hs
+            Fs_prev[:, :width]  = Fs
+        if best['score'] == 0:
+            return None
+        return best
+
+def encode(seq):
+    """ Encode a sequence as integers, other symbols are coded as -1 """
+    codes   = np.frombuffer(seq.upper(), dtype=np.uint8)
+    res     = np.zeros(len(codes), dtype=np.int64) - 1
+    for i, c in enumerate('ACGT'):
+        res[codes == ord(c)]    = i
+    return res
+
+def seed_diagonal(c1, c2, k, max_kmer_hits):
+    """ Find the most supported diagonal (j - i) of two encoded sequences using shared k-mers, None without any """
+    support = diagonal_support(c1, c2, k, max_kmer_hits)
+    if support is None:
+        return None
+    return int(np.argmax(support)) - len(c1)
+
+def diagonal_support(c1, c2, k, max_kmer_hits):
+    """ Count the shared k-mers on the diagonals of two encoded sequences, indexed by j - i + len(c1), None without any """
+    if len(c1) < k or len(c2) < k:
+        return None
+    h1      = kmer_hashes(c1, k)
+    h2      = kmer_hashes(c2, k)
+    order   = np.argsort(h1, kind='mergesort')
+    sorted1 = h1[order]
+    # Look up a subsample of the k-mers of the second sequence:
+    pos2    = np.arange(0, len(h2), max(1, k // 2))
+    left    = np.searchsorted(sorted1, h2[pos2], side='left')
+    right   = np.searchsorted(sorted1, h2[pos2], side='right')
+    diags   = [ ]
+    for p, l, r in zip(pos2, left, right):
+        if h2[p] < 0 or r == l or r - l > max_kmer_hits:
+            continue
+        diags.append(p - order[l:r])
+    if len(diags) == 0:
+        return None
+    diags   = np.concatenate(diags) + len(c1)
+    return np.bincount(diags)
+
+def kmer_hashes(codes, k):
+    """ Hash all k-mers of an encoded sequence, k-mers with other symbols are negative """
+    n       = len(codes) - k + 1
+    h       = np.zeros(n, dtype=np.int64)
+    bad     = np.zeros(n, dtype=bool)
+    for i in xrange(k):
+        part    = codes[i:i+n]
+        h       = h * 4 + np.maximum(part, 0)
+        bad     |= part < 0
+    h[bad]  = -1 - np.arange(np.sum(bad))
+    return h
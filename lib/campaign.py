@@ -0,0 +1,302 @@
+import      utils       as      u
+import      os
+import      time
+import      shlex
+import      shutil
+import      tempfile
+import      subprocess
+import      multiprocessing
+import      argparse
+import      math
+import      hashlib
+import      results
+import      seeding
+
+EXECUTORS   = ('lsf', 'local')
+
+# Memory model of a single sim_exp run, dominated by the reads hashed by velveth:
+MEM_BASE_MB     = 300
+MEM_PER_BASE    = 12
+
+def estimate_memory(target_len, total_cov):
+    """ Estimate the peak memory of a simulated experiment in megabytes """
+    return MEM_BASE_MB + int(float(target_len) * total_cov * MEM_PER_BASE / 2**20)
+
+# Runtime model of a single sim_exp run in seconds per target base and mutant type:
+SECONDS_PER_COST    = 5e-4
+
+def parse_exp_args(exp_args):
+    """ Parse the arguments passed to sim_exp which the cost estimates and the PCR cache depend on """
+    parser  = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-i', type=int, default=None)
+    parser.add_argument('-e', type=float, default=None)
+    parser.add_argument('-cm', type=int, default=None)
+    parser.add_argument('-dm', type=float, default=None)
+    parser.add_argument('-cc', type=int, default=None)
+    parser.add_argument('-dc', type=float, default=None)
+    parser.add_argument('-cf', type=int, default=None)
+    parser.add_argument('-ss', type=int, default=40)
+    parser.add_argument('-pb', type=str, default='R')
+    parser.add_argument('-t', type=int, default=4000)
+    return parser.parse_known_args(exp_args.split())[0]
+
+def total_coverage(exp_args):
+    """ Get the total coverage from the arguments passed to sim_exp """
+    return parse_exp_args(exp_args).t
+
+def expected_mutants(exp_args):
+    """ Approximate the expected number of mutant types from the arguments passed to sim_exp """
+    a   = parse_exp_args(exp_args)
+    if None in (a.i, a.e, a.cm, a.dm, a.cc, a.dc):
+        return 1.0
+    # Molecules surviving the dilutions, the second sample is drawn from the families of the first:
+    n1  = a.i * (1.0 + a.e) ** a.cm / a.dm
+    n2  = n1 * (1.0 + a.e) ** a.cc / a.dc
+    if n1 <= 0.0:
+        return 1.0
+    return max(1.0, n1 * (1.0 - math.exp(-n2 / n1)))
+
+def estimate_runtime(target_len, exp_args):
+    """ Estimate the runtime of a simulated experiment in seconds """
+    return SECONDS_PER_COST * target_len * expected_mutants(exp_args)
+
+# Statuses of sim_exp results which may change when rerun, as the assembly
+# can fail due to resource limits:
+ASSEMBLY_FAILED = (-2, -3)
+
+def param_hash(exp_args):
+    """ Hash the parameter set of a campaign given as sim_exp arguments """
+    return hashlib.sha1(' '.join(exp_args.split())).hexdigest()[:16]
+
+def exp_seed(name, phash):
+    """ Derive the random seed of an experiment from its name and the parameter hash """
+    return seeding.derive_seed(name, phash)
+
+def result_status(out_file):
+    """ Get the status saved by sim_exp, None if the result is missing or malformed """
+    if not os.path.exists(out_file):
+        return None
+    lines   = file(out_file).readlines()
+    if len(lines) != 1 or len(lines[0].split()) != 6:
+        return None
+    return int(lines[0].split()[1])
+
+class Manifest:
+    """ Record of the experiments of a campaign with their seeds and parameter hashes """
+    def __init__(self, fname, exp_args, log, retry=(), store=None):
+        self.fname      = fname
+        self.log        = log
+        self.retry      = retry
+        self.phash      = param_hash(exp_args)
+        self.previous   = { }
+        self.entries    = { }
+        # Statuses of the experiments saved to a results store:
+        self.stored     = None
+        if store != None:
+            res         = results.load(store)
+            self.stored = dict(zip(res['name'], res['status']))
+        if os.path.exists(fname):
+            for line in file(fname):
+                name, seed, phash   = line.split()
+                self.previous[name] = (seed, phash)
+
+    def seed(self, name):
+        """ Register an experiment and get its seed, appending new entries to the manifest right away
+            so that they survive an interrupted campaign, later lines take precedence when loading """
+        seed                = exp_seed(name, self.phash)
+        if self.previous.get(name) != (seed, self.phash) and self.entries.get(name) != (seed, self.phash):
+            fh  = open(self.fname, 'a')
+            fh.write("%s\t%s\t%s\n" % (name, seed, self.phash))
+            fh.flush()
+            fh.close()
+        self.entries[name]  = (seed, self.phash)
+        return seed
+
+    def is_done(self, name, out_file):
+        """ Check whether an experiment has a final result from the same parameter set """
+        if name not in self.previous or self.previous[name][1] != self.phash:
+            return False
+        if self.stored is not None:
+            status  = self.stored.get(name)
+        else:
+            status  = result_status(out_file)
+        return status is not None and status not in self.retry
+
+    def save(self):
+        """ Save the manifest compacted to one line per experiment, keeping the experiments of earlier runs """
+        entries = dict(self.previous)
+        entries.update(self.entries)
+        fh      = open(self.fname, 'w')
+        for name in sorted(entries.iterkeys()):
+            fh.write("%s\t%s\t%s\n" % (name, entries[name][0], entries[name][1]))
+        fh.flush()
+        fh.close()
+
+def physical_memory():
+    """ Get the physical memory of the machine in megabytes """
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2**20
+
+class LsfExecutor:
+    """ Submit every experiment as a job to the LSF system """
+    def __init__(self, log, queue, mem_limit=20000):
+        if queue is None:
+            log.fatal('An LSF queue must be specified!')
+        self.log        = log
+        self.queue      = queue
+        self.mem_limit  = mem_limit
+
+    def submit(self, name, exp_args, log_file, mem=None, runtime=None, prog='bin/sim_exp'):
+        """ Submit a sim_exp or sim_worker run, a fresh run directory is passed as -R """
+        cmd = '"RDIR=\`mktemp --tmpdir -d sim_exp.XXXXX\`;'
+        cmd += '%s %s -R \${RDIR} 2> %s;rm -fr \${RDIR}/"' % (prog, exp_args, log_file)
+        # Jobs with a memory estimate reserve and are limited to it, others get the default limit:
+        if mem is None:
+            mem = self.mem_limit
+        mem = max(mem, MEM_BASE_MB)
+        cmd = "bsub -o /dev/null -J %s -M %d -R \"rusage[mem=%d]\" -q %s " % (name, mem, mem, self.queue) + cmd
+        if os.system(cmd) != 0:
+            self.log.fatal('Failed to submit job for %s!' % name)
+
+    def wait(self):
+        """ Jobs are left to the LSF system """
+        return [ ]
+
+class LocalExecutor:
+    """ Run experiments in parallel on the local machine under a memory budget """
+    def __init__(self, log, run_dir, nr_workers=None, mem_budget=None, max_queued=None, poll=0.2):
+        if nr_workers is None:
+            nr_workers  = multiprocessing.cpu_count()
+        if mem_budget is None:
+            mem_budget  = physical_memory()
+        if max_queued is None:
+            max_queued  = 4 * nr_workers
+        if nr_workers < 1 or max_queued < 1:
+            raise ValueError("The number of workers and the queue size must be positive!")
+        self.log        = log
+        self.run_dir    = run_dir
+        self.nr_workers = nr_workers
+        self.mem_budget = mem_budget
+        self.max_queued = max_queued
+        self.poll       = poll
+        self.queue      = [ ]
+        self.running    = [ ]
+        self.failed     = [ ]
+        self.nr_done    = 0
+
+    def submit(self, name, exp_args, log_file, mem=None, runtime=None, prog='bin/sim_exp'):
+        """ Queue a sim_exp or sim_worker run, blocking while the queue is full """
+        if mem is None:
+            mem = MEM_BASE_MB
+        self.queue.append({'name': name, 'prog': prog, 'args': exp_args, 'log': log_file, 'mem': mem})
+        self._schedule()
+        while len(self.queue) >= self.max_queued:
+            self._reap(block=True)
+            self._schedule()
+
+    def wait(self):
+        """ Wait for all jobs to finish, return the failed jobs """
+        while len(self.queue) > 0 or len(self.running) > 0:
+            self._reap(block=True)
+            self._schedule()
+        if len(self.failed) > 0:
+            self.log.log("%d of %d jobs failed: %s" % (len(self.failed), self.nr_done, ' '.join(j['name'] for j in self.failed)))
+        return self.failed
+
+    def _mem_used(self):
+        """ Memory reserved by the running jobs """
+        return sum(j['mem'] for j in self.running)
+
+    def _schedule(self):
+        """ Start queued jobs in order while workers and memory are available """
+        while len(self.queue) > 0 and len(self.running) < self.nr_workers:
+            job = self.queue[0]
+            # A job larger than the budget runs alone:
+            if len(self.running) > 0 and self._mem_used() + job['mem'] > self.mem_budget:
+                break
+            self._start(self.queue.pop(0))
+
+    def _start(self, job):
+        """ Start a job in its own run directory """
+        job['rdir'] = tempfile.mkdtemp(prefix='sim_exp.', dir=self.run_dir)
+        cmd         = [ job['prog'] ] + shlex.split(job['args']) + [ '-R', job['rdir'] ]
+        job['err']  = open(job['log'], 'w')
+        job['proc'] = subprocess.Popen(cmd, stdout=open(os.devnull, 'w'), stderr=job['err'])
+        self.running.append(job)
+
+    def _reap(self, block=False):
+        """ Collect finished jobs, optionally waiting for at least one """
+        while True:
+            done    = [ j for j in self.running if j['proc'].poll() is not None ]
+            if len(done) > 0 or not block or len(self.running) == 0:
+                break
+            time.sleep(self.poll)
+        for job in done:
+            self.running.remove(job)
+            job['err'].close()
+            shutil.rmtree(job['rdir'], ignore_errors=True)
+            self.nr_done    += 1
+            ret = job['proc'].returncode
+            if ret != 0:
+                job['status']   = ret
+                self.failed.append(job)
+                self.log.log("Job %s failed with exit status %d, see %s" % (job['name'], ret, job['log']))
+
+class Packer:
+    """ Pack experiments into jobs of sim_worker runs lasting about the target wall time """
+    def __init__(self, executor, log, spec_dir, wall_time, nr_procs=1):
+        if wall_time <= 0 or nr_procs < 1:
+            raise ValueError("The wall time and the number of processes must be positive!")
+        self.executor   = executor
+        self.log        = log
+        self.spec_dir   = spec_dir
+        self.wall_time  = wall_time
+        self.nr_procs   = nr_procs
+        self.nr_packs   = self._last_pack() + 1
+        self._reset()
+
+    def _last_pack(self):
+        """ Get the number of the last pack written by an earlier run, so resumed campaigns do not overwrite it """
+        last    = -1
+        for fname in os.listdir(self.spec_dir):
+            base, ext   = os.path.splitext(fname)
+            if ext == '.spec' and base.startswith('pack_') and base[5:].isdigit():
+                last    = max(last, int(base[5:]))
+        return last
+
+    def _reset(self):
+        """ Start a new pack """
+        self.specs      = [ ]
+        self.runtime    = 0.0
+        self.mem        = 0
+
+    def submit(self, name, exp_args, log_file, mem=None, runtime=0.0):
+        """ Add an experiment to the current pack, submit the pack once it is full """
+        if mem is None:
+            mem = MEM_BASE_MB
+        self.specs.append(exp_args)
+        self.runtime    += runtime
+        self.mem        = max(self.mem, mem)
+        if self.runtime >= self.wall_time * self.nr_procs:
+            self.flush()
+
+    def flush(self):
+        """ Submit the current pack as a sim_worker job """
+        if len(self.specs) == 0:
+            return
+        name    = "pack_%05d" % self.nr_packs
+        spec    = os.path.join(self.spec_dir, name + ".spec")
+        fh      = open(spec, 'w')
+        for exp_args in self.specs:
+            fh.write(exp_args + "\n")
+        fh.flush()
+        fh.close()
+        # Experiments log to their own files as with unpacked jobs:
+        worker_args = "-s %s -l -j %d" % (spec, self.nr_procs)
+        self.executor.submit(name, worker_args, os.path.join(self.spec_dir, name + ".log"), mem=self.mem * self.nr_procs, prog='bin/sim_worker')
+        self.nr_packs   += 1
+        self._reset()
+
+    def wait(self):
+        """ Submit the last pack and wait for the executor """
+        self.flush()
+        return self.executor.wait()
@@ -7,12 +7,12 @@ class Exonerate:
     """ Perform pairwise alignments using exonerate  """
     def __init__(self, log, rts):
         self.log        = log
-        self.rts        = rts
+        self.rts        = rts.subdir('exonerate')
         u.check_cmd('exonerate')
 
     def _prepare_input(self, s1, s2):
         """ Save sequences as temporary files """
-        rts = self.rts.subdir('exonerate')
+        rts = self.rts
 
         f1  = rts.tempfile('s1.fas')
         fh1 = open(f1,'w')
@@ -29,6 +29,15 @@ class Exonerate:
         r   = rts.tempfile('out.txt')
         return f1, f2, r
 
+    def _run(self, cmd, r, files):
+        """ Run exonerate, return the lines of its output and remove the files of the run """
+        try:
+            if os.system(cmd) != 0:
+                return None
+            return file(r).readlines()
+        finally:
+            for f in files:
+                self.rts.remove(f)
 
     def check_strands(self, s1, s2):
         """ Check whether two sequences align with the same strand """
@@ -39,11 +48,8 @@ class Exonerate:
         cmd  = """exonerate --verbose 0 --showalignment no --showvulgar no --ryo '%qS|%tS\\n' """
         cmd += "-m affine:local -e -100 -o -100 -n 1 --target %s --query %s > %s" % (f1, f2, r)
 
-        if os.system(cmd) != 0:
-            return None
-
-        ryo = file(r).readlines()
-        if len(ryo) != 1:
+        ryo = self._run(cmd, r, (f1, f2, r))
+        if ryo is None or len(ryo) != 1:
             return None
 
         ryo = ryo[0].rstrip()
@@ -57,6 +63,35 @@ class Exonerate:
         else:
             return True
         
+    def check_strands_batch(self, s1, seqs):
+        """ Check the strands of all sequences in seqs against s1 in one exonerate run """
+        if len(s1) == 0 or len(seqs) == 0:
+            return dict( (name, None) for name in seqs.iterkeys() )
+        rts = self.rts
+        f1  = rts.tempfile('s1.fas')
+        u.write_fasta({'s1': s1}, f1)
+        f2  = rts.tempfile('queries.fas')
+        u.write_fasta(dict( (name, seq) for name, seq in seqs.iteritems() if len(seq) > 0 ), f2)
+        r   = rts.tempfile('out.txt')
+
+        cmd  = """exonerate --verbose 0 --showalignment no --showvulgar no --ryo '%qi|%qS|%tS\\n' """
+        cmd += "-m affine:local -e -100 -o -100 -n 1 --target %s --query %s > %s" % (f1, f2, r)
+
+        res = dict( (name, None) for name in seqs.iterkeys() )
+        out = self._run(cmd, r, (f1, f2, r))
+        if out is None:
+            return res
+
+        # Parse the strands of the best hit for every query:
+        for line in out:
+            line    = line.rstrip()
+            if line == '':
+                continue
+            name, qs, ts    = line.split('|')
+            if name in res and res[name] is None:
+                res[name]   = (qs != ts)
+        return res
+
     def seq_cmp(self, s1, s2):
         """ Compare two sequences by pairwise alignment """
         f1, f2, r   = self._prepare_input(s1, s2)
@@ -64,11 +99,8 @@ class Exonerate:
         cmd  = "exonerate --verbose 0 --showalignment no --showvulgar no -m affine:local -e -100 -o -100 --ryo '%tab|%tae|%pi\\n' -n 1 "
         cmd += "--target %s --query %s > %s " % (f1, f2, r)
 
-        if os.system(cmd) != 0:
-            return None
-
-        ryo = file(r).readlines()
-        if len(ryo) != 1:
+        ryo = self._run(cmd, r, (f1, f2, r))
+        if ryo is None or len(ryo) != 1:
             return None
 
         ryo = ryo[0].rstrip()
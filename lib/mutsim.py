@@ -3,15 +3,30 @@ import      os
 import      dendropy
 import      numpy       as      np
 
+# Available substitution engines:
+ENGINES = ('site', 'vector', 'jump')
+
 class MutSim:
     """ Simulate mutations along a tree using a continous-time Markov process """
-    def __init__(self, model_file, bl_scaler=1.0, alphabet=('A', 'T','G','C')):
+    def __init__(self, model_file, bl_scaler=1.0, alphabet=('A', 'T','G','C'), engine='site'):
+        if engine not in ENGINES:
+            raise ValueError("Unknown substitution engine: %s" % engine)
         self.model_file = model_file
         self.alphabet   = alphabet
+        self.engine     = engine
         self.epsilon    = 10.0**-10 # A small value.
         self.model      = self.read_model(model_file)
         self.bl_scaler  = bl_scaler
-        u.check_cmd('R')
+        self.rng        = np.random
+        self._init_codes()
+
+    def _init_codes(self):
+        """ Build lookup tables for integer coding of sequences """
+        self.symbols    = np.array([ord(s) for s in self.alphabet], dtype=np.uint8)
+        self.no_delta   = (np.zeros(0, dtype=int), np.zeros(0, dtype=np.uint8))
+        self.codes      = np.zeros(256, dtype=np.int8) - 1
+        for i in xrange(len(self.alphabet)):
+            self.codes[ord(self.alphabet[i])] = i
 
     def read_model(self, model_file):
         """ Read mutation model from file """
@@ -31,6 +46,18 @@ class MutSim:
         # Precalculate eigen-decomposition:
         self.u, self.v  = np.linalg.eig(self.m)
         self.v_inv      = np.linalg.inv(self.v)
+        # Precalculate uniformized jump chain:
+        self._init_jumps()
+
+    def _init_jumps(self):
+        """ Uniformize the scaled Q matrix for the jump engine """
+        q               = np.asarray(self.m)
+        # Events arrive at every site with the maximal exit rate, and
+        # resolve according to R = I + Q/rate (possibly a silent jump):
+        self.jump_rate  = np.max(-np.diag(q))
+        R               = np.identity(q.shape[0]) + q / self.jump_rate
+        self.jump_cum   = np.cumsum(R, axis=1)
+        self.jump_cum[:, -1] = 1.0
 
     def _check_root_seq(self, root_seq):
         """ Check the validity of the root sequence """
@@ -93,37 +120,101 @@ class MutSim:
         P    = np.dot( np.dot(v, U), v_inv)
         return P
 
-    def sim(self, tree, root_seq):
-        """ Simulate substitutions along a tree """
+    def sim(self, tree, root_seq, rng=np.random):
+        """ Simulate substitutions along a tree, drawing from the specified random stream """
         if not tree.is_rooted:
             raise ValueError("Cannot simulate on unrooted tree!")
-        self._check_root_seq(root_seq)
+        self.rng        = rng
         self.root_seq   = root_seq
         self.sequences  = { }
+        self.deltas     = { }
         count           = 0
 
+        # The site engine keeps a string for every node, the other
+        # engines keep the substitutions relative to the tail node
+        # as position/base arrays:
+        if self.engine == 'site':
+            self._check_root_seq(root_seq)
+            self.root       = root_seq
+        else:
+            self.root       = self.encode(root_seq)
+
         for edge in tree.preorder_edge_iter():
             # Discarding edges with illegal lengths:
             if edge.length is None:
                 continue
-            tail_seq    =   self._get_seq(edge.tail_node, count)
-            head_seq    =   self._evolve_branch(seq=tail_seq, length=(edge.length * self.bl_scaler))
-            self.sequences[edge.head_node]  = head_seq
+            length  = edge.length * self.bl_scaler
+            if self.engine == 'site':
+                tail_seq    =   self._get_seq(edge.tail_node, count)
+                head_seq    =   self._evolve_branch(tail_seq, length)
+                self.sequences[edge.head_node]  = head_seq
+            else:
+                tail_codes  =   self._get_codes(edge.tail_node, count)
+                self.deltas[edge.head_node]     = self._evolve_delta(tail_codes, length)
 
-    def get_tips(self):
-        """ Get the tip labels from a dendropy object """
+    def get_tips(self, names=None):
+        """ Get the tip sequences, optionally only for the specified tip labels """
+        if names is not None:
+            names   = set(names)
         res = { }
-        for node, seq in self.sequences.iteritems():
-            if node.is_leaf():
-               res[node.taxon.label] = seq 
+        if self.engine == 'site':
+            for node, seq in self.sequences.iteritems():
+                if node.is_leaf() and (names is None or node.taxon.label in names):
+                   res[node.taxon.label] = seq 
+            return res
+        # Build the requested tip sequences from the deltas:
+        for node in self.deltas.iterkeys():
+            if node.is_leaf() and (names is None or node.taxon.label in names):
+               res[node.taxon.label] = self.decode(self._build_codes(node))
         return res
 
+    def encode(self, seq):
+        """ Encode a sequence as an array of alphabet indices """
+        codes   = self.codes[np.frombuffer(seq, dtype=np.uint8)]
+        bad     = np.where(codes < 0)[0]
+        if len(bad) > 0:
+            raise ValueError("Root sequence symbol %s not in alphabet!" % seq[bad[0]])
+        return codes.astype(np.uint8)
+
+    def decode(self, codes):
+        """ Decode an array of alphabet indices into a sequence """
+        return self.symbols[codes].tostring()
+
     def _get_seq(self, node, count):
         """ Get the sequence associated with a node """
         if count == 0:
-           self.sequences[node] =   self.root_seq
+           self.sequences[node] =   self.root
         return self.sequences[node]
 
+    def _get_codes(self, node, count):
+        """ Get the integer-coded sequence associated with a node """
+        if count == 0:
+           self.deltas[node]    =   self.no_delta
+        return self._build_codes(node)
+
+    def _build_codes(self, node):
+        """ Apply the deltas on the path from the root to a node """
+        path    = [ ]
+        while node in self.deltas:
+            pos, bases  = self.deltas[node]
+            if len(pos) > 0:
+                path.append((pos, bases))
+            node    = node.parent_node
+        if len(path) == 0:
+            return self.root
+        codes   = self.root.copy()
+        for pos, bases in reversed(path):
+            codes[pos]  = bases
+        return codes
+
+    def _evolve_delta(self, codes, length):
+        """ Simulate substitutions along a branch and return the changed sites """
+        if self.engine == 'jump':
+            return self._evolve_jumps(codes, length)
+        new_codes   = self._evolve_codes(codes, length)
+        pos         = np.where(new_codes != codes)[0]
+        return pos, new_codes[pos]
+
     def _evolve_branch(self, seq, length):
         """ Simulate substitutions along a branch """
         if length == 0:
@@ -134,11 +225,45 @@ class MutSim:
             symbols     = self.alphabet
             probs       = np.array(P[self.alphabet.index(sites[i]),])
             probs.shape = 4
-            new_idx     = np.random.multinomial(1, probs, 1)[0]
+            new_idx     = self.rng.multinomial(1, probs, 1)[0]
             new_idx     = np.where(new_idx == 1)[0][0]
             sites[i]    = self.alphabet[ new_idx ]
         return ''.join(sites) 
 
+    def _evolve_codes(self, codes, length):
+        """ Simulate substitutions along a branch on an integer-coded sequence """
+        if length == 0:
+            return codes
+        # Sample the new state of every site by inverting the cumulative
+        # rows of P with a single uniform draw per site:
+        P           = np.real(np.asarray(self.calc_P(length)))
+        cum         = np.cumsum(P, axis=1)
+        cum[:, -1]  = 1.0
+        r           = self.rng.random_sample(len(codes))
+        new_codes   = np.sum(r[:, np.newaxis] >= cum[codes], axis=1)
+        return new_codes.astype(np.uint8)
+
+    def _evolve_jumps(self, codes, length):
+        """ Simulate substitutions along a branch by placing substitution events """
+        if length == 0:
+            return self.no_delta
+        nr_events   = self.rng.poisson(self.jump_rate * length * len(codes))
+        if nr_events == 0:
+            return self.no_delta
+        pos         = self.rng.randint(0, len(codes), nr_events)
+        sites       = np.unique(pos)
+        states      = codes[sites]
+        events      = np.searchsorted(sites, pos)
+        # Resolve events in rounds, so sites hit more than once
+        # jump from their updated state:
+        while len(events) > 0:
+            hit, first      = np.unique(events, return_index=True)
+            r               = self.rng.random_sample(len(hit))
+            states[hit]     = np.sum(r[:, np.newaxis] >= self.jump_cum[states[hit]], axis=1)
+            events          = np.delete(events, first)
+        changed     = np.where(states != codes[sites])[0]
+        return sites[changed], states[changed]
+
 def calc_basefreq(seq):
     """ Calculate base frequencies of a sequence """ 
     alphabet    = ('A','T','G','C')
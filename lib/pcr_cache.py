@@ -0,0 +1,116 @@
+import      utils       as      u
+import      sim_exp
+import      seeding
+import      os
+import      hashlib
+import      dendropy
+import      numpy       as      np
+
+def pcr_params(init_popsize, pcr_eff, nr_cycles_mut, dilf_after_mut, nr_cycles_cln, dilf_after_cln, nr_cycles_cov, sample_size_mut, backend):
+    """ Collect the parameters and the backend determining the PCR genealogies and coverages """
+    return {
+        'init_popsize':     int(init_popsize),
+        'pcr_eff':          float(pcr_eff),
+        'nr_cycles_mut':    int(nr_cycles_mut),
+        'dilf_after_mut':   float(dilf_after_mut),
+        'nr_cycles_cln':    int(nr_cycles_cln),
+        'dilf_after_cln':   float(dilf_after_cln),
+        'nr_cycles_cov':    int(nr_cycles_cov),
+        'sample_size_mut':  int(sample_size_mut),
+        'backend':          str(backend),
+    }
+
+def param_key(params):
+    """ Hash a parameter set into a store key """
+    tmp = ";".join([ "%s=%r" % (k, params[k]) for k in sorted(params.keys()) ])
+    return hashlib.sha1(tmp).hexdigest()[:16]
+
+def draw_stream(seed, key, index):
+    """ Get the random stream of a draw, the global generator if unseeded """
+    if seed is None:
+        return np.random
+    return seeding.stream(seed, key, index)
+
+class PcrCache:
+    """ On-disk store of precomputed PCR genealogies and coverages """
+    def __init__(self, cache_dir, params, log):
+        self.log        = log
+        self.params     = params
+        self.key        = param_key(params)
+        if os.path.isdir(cache_dir) != True:
+            log.fatal("The cache must be a directory: %s" % cache_dir)
+        self.fname      = os.path.join(cache_dir, self.key + ".npz")
+        self.store      = None
+
+    def exists(self):
+        """ Check whether the store for the parameter set exists """
+        return os.path.exists(self.fname)
+
+    def generate(self, nr_draws, path, seed=None):
+        """ Simulate independent draws and save them to the store, every draw from its own stream if seeded """
+        nwks    = [ ]
+        offsets = [ 0 ]
+        names   = [ ]
+        fracs   = [ ]
+        for i in xrange(nr_draws):
+            lab     = sim_exp.SimPcrDil(
+                name            = 'pcr_cache_' + self.key,
+                total_cov       = 1,
+                path            = path,
+                log             = self.log,
+                clean           = True,
+                rng             = draw_stream(seed, self.key, i),
+                **self.params
+            )
+            res     = lab.simulate()
+            nwk     = ''
+            if len(res['cov']) > 0:
+                nwk = res['tree'].as_string(schema='newick').strip()
+            nwks.append(nwk)
+            for name, frac in res['cov_perc'].iteritems():
+                names.append(name)
+                fracs.append(frac)
+            offsets.append(len(names))
+
+        # Write to a temporary file first, so readers never see partial stores:
+        tmp = self.fname + ".tmp"
+        fh  = open(tmp, "wb")
+        np.savez_compressed(fh,
+            nwk     = np.array(nwks, dtype=str),
+            cov_off = np.array(offsets, dtype=np.int64),
+            cov_name= np.array(names, dtype=str),
+            cov_frac= np.array(fracs, dtype=float),
+        )
+        fh.flush()
+        fh.close()
+        os.rename(tmp, self.fname)
+
+    def _load(self):
+        """ Load the store """
+        if not self.exists():
+            self.log.fatal("No PCR genealogy store for this parameter set: %s" % self.fname)
+        if self.store is None:
+            tmp         = np.load(self.fname)
+            self.store  = dict( (k, tmp[k]) for k in tmp.files )
+            tmp.close()
+        return self.store
+
+    def size(self):
+        """ Get the number of draws in the store """
+        return len(self._load()['nwk'])
+
+    def draw(self, index, total_cov):
+        """ Get a draw in the format returned by SimPcrDil.simulate """
+        store   = self._load()
+        if index < 0 or index >= len(store['nwk']):
+            self.log.fatal("Draw %d is not in the PCR genealogy store (size: %d)!" % (index, len(store['nwk'])))
+        start, end  = store['cov_off'][index], store['cov_off'][index+1]
+        cov     = { }
+        perc    = { }
+        for name, frac in zip(store['cov_name'][start:end], store['cov_frac'][start:end]):
+            cov[name]   = int(frac * total_cov)
+            perc[name]  = frac
+        res     = {'cov': cov, 'cov_perc': perc}
+        if len(cov) > 0:
+            res['tree'] = dendropy.Tree.get_from_string(str(store['nwk'][index]), schema='newick', as_rooted=True)
+        return res
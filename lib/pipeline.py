@@ -0,0 +1,265 @@
+import      utils       as      u
+import      sim_exp
+import      pcr_cache
+import      mutsim
+import      os
+import      shlex
+import      argparse
+import      simngs
+import      readsim
+import      velvet
+import      exonerate
+import      strands
+import      muscle
+import      bandaln
+import      staraln
+import      results
+import      seeding
+
+# Substitution simulators loaded by this process:
+_mutsims    = { }
+
+def arg_parser():
+    """ Get the parser of the sim_exp arguments """
+    parser = argparse.ArgumentParser(description='Simulate NG-SAM experiment.')
+    parser.add_argument('-f', metavar='target_seq', type=str, default=None, help='Target sequence in fasta format.', required=True)
+    parser.add_argument('-n', metavar='mut_model', type=str, default=None, help='Mutation model file.', required=True)
+    parser.add_argument('-b', metavar='bl_file', type=str, default=None, help='Branch length scaler file.', required=True)
+    parser.add_argument('-i', metavar='init_popsize', type=int, default=None, help='Initial molecule number.', required=True)
+    parser.add_argument('-e', metavar='pcr_eff', type=float, default=None, help='PCR efficiency.', required=True)
+    parser.add_argument('-cm', metavar='cycles_mut', type=int, default=None, help='Number of mutagenic cycles.', required=True)
+    parser.add_argument('-dm', metavar='df_mut', type=float, default=None, help='Dilution factor after mutation.', required=True)
+    parser.add_argument('-cc', metavar='cycles_clean', type=int, default=None, help='Number of cleanup cycles.', required=True)
+    parser.add_argument('-dc', metavar='df_clean', type=float, default=None, help='Dilution factor after cleanup PCR.', required=True)
+    parser.add_argument('-cf', metavar='cycles_final', type=int, default=None, help='Number of final cycles.', required=True)
+    parser.add_argument('-ss', metavar='sample_size', type=int, default=40, help='Mutation genealogy sample size (R backend).')
+    parser.add_argument('-vm', metavar='min_ctgl', type=int, default=None, help='Velvet: minimum contig length.', required=True)
+    parser.add_argument('-vk', metavar='kmer_length', type=int, default=None, help='Velvet: kmer_length.', required=True)
+    parser.add_argument('-vi', metavar='v_ins', type=int, default=None, help='Velvet: insert_size.', required=True)
+    parser.add_argument('-vd', metavar='v_max_div', type=float, default=None, help='Velvet: max_div.', required=True)
+    parser.add_argument('-o', metavar='out_dir', type=str, default=".", help='Output directory.')
+    parser.add_argument('-N', metavar='name', type=str, default=None, help='Overwrite target name.')
+    parser.add_argument('-P', metavar='bin_path', type=str, default=None, help='Path to pcr_coal.R.',required=True)
+    parser.add_argument('-R', metavar='run_path', type=str, default=None, help='Run path.', required=True)
+    parser.add_argument('-S', metavar='run_file', type=str, default=None, help='SimNGS runfile.', required=True)
+    parser.add_argument('-L', metavar='read_length', type=int, default=None, help='Read length.', required=True)
+    parser.add_argument('-I', metavar='insert_size', type=int, default=None, help='Mean insert size.', required=True)
+    parser.add_argument('-t', metavar='total_cov', type=int, default=None, help='Total coverage.')
+    parser.add_argument('-pb', metavar='pcr_backend', type=str, default='R', choices=sim_exp.BACKENDS, help='PCR simulation backend.')
+    parser.add_argument('-G', metavar='pcr_cache', type=str, default=None, help='Draw the PCR genealogy from this cache directory.')
+    parser.add_argument('-Gi', metavar='cache_index', type=int, default=None, help='Index of the draw in the PCR genealogy cache.')
+    parser.add_argument('-U', metavar='pcr_state', type=str, default=None, help='Continue from a saved PCR simulation stage.')
+    parser.add_argument('-rs', metavar='read_sim', type=str, default='simngs', choices=('native', 'simngs'), help='Read simulator: in-process runfile model or simNGS.')
+    parser.add_argument('-so', metavar='strand_method', type=str, default='exonerate', choices=('kmer', 'exonerate'), help='Contig orientation: k-mer voting with exonerate fallback, or exonerate only.')
+    parser.add_argument('-me', metavar='mut_engine', type=str, default='site', choices=mutsim.ENGINES, help='Substitution engine.')
+    parser.add_argument('-Rs', metavar='results_store', type=str, default=None, help='Append the results to this store instead of writing an .out file.')
+    parser.add_argument('-pf', action='store_true', default=False, help='Save the time and memory used by the stages to <out_dir>/<name>.prof.')
+    parser.add_argument('-sd', metavar='seed', type=str, default=None, help='Random seed, the stages draw from their own streams derived from it.')
+    parser.add_argument('-ma', metavar='msa_method', type=str, default='muscle', choices=('muscle', 'star'), help='Contig alignment: muscle, or star alignment to a growing anchor.')
+    parser.add_argument('-st', action='store_true', default=False, help='Stream the reads into velveth through a named pipe instead of a FASTA file, the reads stage is then timed with velveth.')
+    parser.add_argument('-Rm', metavar='scratch_dir', type=str, default=None, help='Keep the temporary files in this RAM backed directory, like /dev/shm.')
+    parser.add_argument('-Rb', metavar='scratch_mb', type=int, default=1024, help='Size budget of the scratch directory in megabytes, counted as the growth of its filesystem, further files are spilled to the run path.')
+    parser.add_argument('-ac', metavar='aln_cmp', type=str, default='exonerate', choices=('band', 'exonerate', 'check'), help='Final comparison: in-process banded alignment, exonerate, or both with a report of differences.')
+    return parser
+
+def parse_spec(line):
+    """ Parse an experiment specification given as sim_exp arguments """
+    return arg_parser().parse_args(shlex.split(line))
+
+def exp_name(args):
+    """ Get the name of an experiment """
+    if args.N != None:
+        return args.N
+    return u.parse_target_seq(args.f)['full_name']
+
+def get_mutsim(model_file, bl_scaler, engine):
+    """ Get a substitution simulator, reading every model once per process """
+    key = (os.path.abspath(model_file), bl_scaler, engine)
+    if key not in _mutsims:
+        _mutsims[key]   = mutsim.MutSim(model_file, bl_scaler=bl_scaler, engine=engine)
+    return _mutsims[key]
+
+def run_experiment(args, log):
+    """ Simulate a single NG-SAM experiment, save and return the results """
+    streams     = seeding.Streams(args.sd)
+    ts          = u.parse_target_seq(args.f)
+    if args.N != None:
+        ts['full_name'] = args.N
+    exp_name    = ts['full_name']
+    store       = None
+    if args.Rs != None:
+        store   = results.ResultStore(args.Rs)
+    res         = u.Res(os.path.join(args.o, exp_name + ".out"), exp_name, store)
+    rd          = u.Rtemp(args.R, log, scratch=args.Rm, scratch_mb=args.Rb).subdir(exp_name)
+    prof        = u.Profile(rd)
+    try:
+        result  = _simulate(args, ts, log, rd, prof, streams)
+    finally:
+        prof.end()
+        if args.Rm != None:
+            prof.note('spilled', rd.pool['spilled'])
+        # Aborted runs can leave unregistered files behind:
+        try:
+            rd.clean()
+        except OSError:
+            rd.purge()
+    res.save(**result)
+    if args.pf:
+        prof.save(os.path.join(args.o, exp_name + ".prof"))
+    result['name']      = exp_name
+    result['profile']   = prof
+    return result
+
+def _simulate(args, ts, L, rd, prof, streams):
+    """ Run the simulation stages, return the status and the measurements """
+    bl_scaler   = u.parse_bl_file(args.b)
+    prof.note('targ_len', len(ts['seq']))
+    prof.begin('pcr')
+
+    # Simulate PCR and dilution experiments, or draw them from the cache:
+    if args.G != None:
+        if args.Gi is None:
+            L.fatal("A cache index must be specified with -Gi!")
+        params      = pcr_cache.pcr_params(args.i, args.e, args.cm, args.dm, args.cc, args.dc, args.cf, args.ss, args.pb)
+        lab_res     = pcr_cache.PcrCache(args.G, params, L).draw(args.Gi, args.t)
+    else:
+        lab      = sim_exp.SimPcrDil(
+                    name            = ts['full_name'],
+                    init_popsize    = args.i,
+                    pcr_eff         = args.e,
+                    nr_cycles_mut   = args.cm,
+                    dilf_after_mut  = args.dm,
+                    nr_cycles_cln   = args.cc,
+                    dilf_after_cln  = args.dc,
+                    nr_cycles_cov   = args.cf,
+                    total_cov       = args.t,
+                    sample_size_mut = args.ss,
+                    path            = args.P,
+                    log             = L,
+                    clean           = True,
+                    backend         = args.pb,
+                    rng             = streams.get('pcr'),
+                )
+        state       = None
+        if args.U != None:
+            state   = sim_exp.load_state(args.U)
+        lab_res     = lab.simulate(state)
+    mutant_types    = lab_res['cov']
+    prof.note('nmut', len(mutant_types))
+
+    # Abort if we have no mutant types after simulating NG-SAM:
+    if len(mutant_types) == 0:
+        return { 'status': -1 }
+
+    # Simulate mutations, unless forked from a row of already mutated molecules:
+    prof.begin('mutsim')
+    if 'seqs' in lab_res:
+        tips    = lab_res['seqs']
+    else:
+        ms      = get_mutsim(args.n, bl_scaler, args.me)
+        ms.sim(lab_res['tree'], ts['seq'], streams.get('mutsim'))
+        tips    = ms.get_tips(mutant_types.keys())
+
+    # Simulate sequencing of mutant types, in-process or using simNGS:
+    prof.begin('reads')
+    seqs    = dict( (name, (tips[name], cov)) for name, cov in mutant_types.iteritems() )
+    prof.note('read_pairs', sum( simngs.nr_fragments(len(seq), cov, args.L) for seq, cov in seqs.itervalues() ))
+    fqs, fasta, reads   = None, None, None
+    if args.rs == 'native':
+        ngs     = readsim.ReadSim(args.S, args.L, args.I, L, rd, rng=streams.get('reads'))
+        if args.st:
+            # The reads are simulated while velveth consumes them:
+            reads   = ngs.iter_fasta(seqs)
+        else:
+            fasta   = ngs.sim_batch(seqs, fmt='fasta')[0]
+    else:
+        # simNGS writes the paired FASTQ files, which are interleaved while velveth consumes them:
+        ngs     = simngs.SimNGS(args.S, args.L, args.I, L, rd, rng=streams.get('reads'))
+        fqs     = ngs.sim_batch(seqs)
+        if args.st:
+            reads   = velvet.iter_interleaved(fqs[0], fqs[1], L)
+
+    # Assemble reads using velvet:
+    v   = velvet.Velvet(fqs=fqs, kmer_length=args.vk, min_ctgl=args.vm, ins_len=args.vi, max_div=args.vd, rts=rd, log=L, fasta=fasta, reads=reads)
+
+    prof.begin('velveth')
+    ret = v.velveth()
+    # Abort if hashing failed:
+    if ret is None:
+        return { 'status': -2 }
+
+    prof.begin('velvetg')
+    ret = v.velvetg()
+    # Abort if assembly failed:
+    if ret is None:
+        return { 'status': -3 }
+
+    contigs = v.parse_contigs()
+    # Abort if no contigs are reported:
+    if contigs is None:
+        return { 'status': -4 }
+
+    prof.note('contigs', len(contigs))
+    prof.note('contig_len', sum( len(seq) for seq in contigs.itervalues() ))
+
+    # Find the largest contig:
+    max_len     = 0
+    max_name    = None
+    for name, seq in contigs.iteritems():
+        if len(seq) > max_len:
+            max_name    = name
+            max_len     = len(seq)
+
+    # Create Exonerate instance, checked for only when first used:
+    exn = u.Lazy(exonerate.Exonerate, L, rd)
+
+    # Check strandedness and reverse complement to match the longest contig:
+    prof.begin('strands')
+    voter   = None
+    if args.so == 'kmer':
+        voter   = strands.StrandVote()
+    others  = dict( (name, seq) for name, seq in contigs.iteritems() if name != max_name )
+    for name, s in strands.orient(contigs[max_name], others, exn, voter).iteritems():
+        # Abort if strand check failed:
+        if s is None:
+            return { 'status': -5 }
+        if s:
+            contigs[name]   = u.revcomp(contigs[name])
+
+    # Align contigs using muscle or star alignment:
+    prof.begin('msa')
+    if args.ma == 'star':
+        mus = staraln.StarAligner(L, fallback=u.Lazy(muscle.Muscle, L, rd))
+    else:
+        mus = muscle.Muscle(L, rd)
+    aln = mus.align_contigs(contigs)
+    # Abort if multiple alignment failed:
+    if aln is None:
+        return { 'status': -6 }
+
+    # Calculate majority-rule consensus:
+    prof.begin('consensus')
+    prof.note('aln_len', aln.get_alignment_length())
+    consensus   = u.consensus(aln)
+
+    # Compare the consensus to the target:
+    prof.begin('compare')
+    if args.ac == 'exonerate':
+        sim = exn.seq_cmp(ts['seq'], consensus)
+    else:
+        sim = bandaln.BandAligner(L, fallback=exn).seq_cmp(ts['seq'], consensus)
+        if args.ac == 'check':
+            ref = exn.seq_cmp(ts['seq'], consensus)
+            if ref != sim:
+                L.log("Banded alignment differs from exonerate: %s vs. %s" % (sim, ref))
+    # Abort if realignment failed:
+    if sim is None:
+        return { 'status': -7 }
+
+    return {
+        'status':       0,
+        'nmut':         len(mutant_types),
+        'targ_len':     len(ts['seq']),
+        'cons_len':     sim['alignment_length'],
+        'seq_ident':    sim['percent_identity'],
+    }
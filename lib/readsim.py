@@ -0,0 +1,177 @@
+import      utils       as      u
+import      simngs
+import      os
+import      numpy       as      np
+
+# Channel order of the runfile intensities:
+CHANNELS    = 'ACGT'
+
+# Runfiles loaded by this process:
+_runfiles   = { }
+
+def load_runfile(fname):
+    """ Load a runfile once per process """
+    fname   = os.path.abspath(fname)
+    if fname not in _runfiles:
+        _runfiles[fname]    = RunFile(fname)
+    return _runfiles[fname]
+
+class RunFile:
+    """ Error model parsed from a simNGS runfile """
+    def __init__(self, fname):
+        self.fname  = fname
+        self.ends   = [ ]
+        self._parse(fname)
+
+    def _parse(self, fname):
+        """ Parse the brightness distribution and intensity covariance for every end """
+        lines   = [ l.split() for l in file(fname) if not l.startswith('#') and len(l.strip()) > 0 ]
+        if lines[0][0] != 'Version':
+            raise ValueError("Malformed runfile: %s" % fname)
+        i   = 1
+        while i < len(lines):
+            ncycles, dist, loc, scale   = lines[i][:4]
+            ncycles = int(ncycles)
+            if dist != 'L':
+                raise ValueError("Unsupported brightness distribution in runfile: %s" % dist)
+            dim     = 4 * ncycles
+            cov     = np.array([ [float(x) for x in l] for l in lines[i+1:i+1+dim] ])
+            if cov.shape != (dim, dim):
+                raise ValueError("Malformed covariance matrix in runfile: %s" % fname)
+            self.ends.append({
+                'ncycles':  ncycles,
+                'loc':      float(loc),
+                'scale':    float(scale),
+                'cov':      cov,
+            })
+            i   += 1 + dim
+        if len(self.ends) != 2:
+            raise ValueError("The runfile must describe paired reads: %s" % fname)
+
+    def end_model(self, end, read_length):
+        """ Get the model of an end for the first read_length cycles """
+        model   = self.ends[end]
+        if read_length > model['ncycles']:
+            raise ValueError("Read length is larger than the number of cycles in the runfile!")
+        key     = ('chol', read_length)
+        if key not in model:
+            cov         = model['cov'][:4*read_length, :4*read_length]
+            model[key]  = (np.linalg.cholesky(cov), np.diag(cov).reshape((read_length, 4)))
+        return model['loc'], model['scale'], model[key][0], model[key][1]
+
+class ReadSim:
+    """ Simulate Illumina sequencing in-process using the error model of a simNGS runfile """
+    def __init__(self, run_file, read_length, insert_size, log, rts, ins_sd=20.0, max_qual=40, rng=np.random):
+        self.log        = log
+        self.rng        = rng
+        self.rts        = rts
+        self.read_length= read_length
+        self.insert_size= insert_size
+        self.ins_sd     = ins_sd
+        self.max_qual   = max_qual
+        self.runfile    = load_runfile(run_file)
+        self.codes      = np.zeros(256, dtype=np.int8) - 1
+        for i in xrange(len(CHANNELS)):
+            self.codes[ord(CHANNELS[i])]    = i
+        self.symbols    = np.array([ord(c) for c in CHANNELS], dtype=np.uint8)
+
+    def sim_batch(self, seqs, prefix="reads", fmt='fastq'):
+        """ Simulate from all sequences, seqs maps names to (sequence, coverage) """
+        if fmt == 'fastq':
+            fnames  = [ self.rts.tempfile("%s_end1.fq" % prefix), self.rts.tempfile("%s_end2.fq" % prefix) ]
+        elif fmt == 'fasta':
+            fnames  = [ self.rts.tempfile("%s.fas" % prefix) ]
+        else:
+            raise ValueError("Unknown read format: %s" % fmt)
+        fhs     = [ open(f, "w") for f in fnames ]
+        for chunks in self.iter_formatted(seqs, fmt):
+            for fh, chunk in zip(fhs, chunks):
+                fh.write(chunk)
+        for fh in fhs:
+            fh.flush()
+            fh.close()
+        return fnames
+
+    def iter_formatted(self, seqs, fmt='fasta'):
+        """ Iterate over chunks of simulated read pairs formatted as interleaved FASTA, or as paired FASTQ """
+        for chunks in self.iter_reads(seqs):
+            yield self._format(chunks, fmt)
+
+    def iter_fasta(self, seqs):
+        """ Iterate over chunks of simulated read pairs as interleaved FASTA, to be streamed into velveth """
+        for chunks in self.iter_formatted(seqs, 'fasta'):
+            yield chunks[0]
+
+    def iter_reads(self, seqs, chunk_size=10000):
+        """ Iterate over chunks of simulated read pairs as (names, bases, quals) for both ends """
+        for name, (seq, cov) in seqs.iteritems():
+            if len(seq) < self.read_length:
+                raise ValueError("Sequence %s is shorter than the read length!" % name)
+            codes       = self._encode(seq)
+            nr_frags    = simngs.nr_fragments(len(seq), cov, self.read_length)
+            for offset in xrange(0, nr_frags, chunk_size):
+                n       = min(chunk_size, nr_frags - offset)
+                starts, lengths, strands    = simngs.sample_fragments(len(seq), n, self.read_length, self.insert_size, self.ins_sd, self.rng)
+                fwd, rev    = self._fragment_ends(codes, starts, lengths)
+                # Reverse strand fragments are read from their other end:
+                end1        = np.where(strands[:, np.newaxis], rev, fwd)
+                end2        = np.where(strands[:, np.newaxis], fwd, rev)
+                names       = [ "%s_%d" % (name, offset + i) for i in xrange(n) ]
+                yield names, self._call(end1, 0), self._call(end2, 1)
+
+    def _encode(self, seq):
+        """ Encode a sequence as channel indices, ambiguous bases are random """
+        codes   = self.codes[np.frombuffer(seq.upper(), dtype=np.uint8)].astype(int)
+        bad     = codes < 0
+        codes[bad]  = self.rng.randint(0, 4, np.sum(bad))
+        return codes
+
+    def _fragment_ends(self, codes, starts, lengths):
+        """ Get the forward read from the start and the reverse complemented read from the end of fragments """
+        cycles  = np.arange(self.read_length)
+        fwd     = codes[starts[:, np.newaxis] + cycles]
+        rev     = 3 - codes[(starts + lengths - 1)[:, np.newaxis] - cycles]
+        return fwd, rev
+
+    def _call(self, bases, end):
+        """ Simulate intensities for the true bases, then call bases and qualities """
+        n, rl                   = bases.shape
+        loc, scale, chol, var   = self.runfile.end_model(end, rl)
+        # Cluster brightness from the logistic distribution, truncated at zero:
+        lam     = self.rng.logistic(loc, scale, n)
+        while np.any(lam <= 0):
+            bad         = lam <= 0
+            lam[bad]    = self.rng.logistic(loc, scale, np.sum(bad))
+        # Intensities with correlated noise across channels and cycles:
+        noise   = np.dot(self.rng.standard_normal((n, 4 * rl)), chol.T).reshape((n, rl, 4))
+        signal  = np.zeros((n, rl, 4))
+        signal[np.arange(n)[:, np.newaxis], np.arange(rl), bases]    = 1.0
+        x       = lam[:, np.newaxis, np.newaxis] * signal + noise
+        # Posterior of the bases using the per-channel variances:
+        lam     = lam[:, np.newaxis, np.newaxis]
+        score   = (2.0 * lam * x - lam**2) / (2.0 * var)
+        score   -= np.max(score, axis=2)[:, :, np.newaxis]
+        post    = np.exp(score)
+        post    /= np.sum(post, axis=2)[:, :, np.newaxis]
+        calls   = np.argmax(post, axis=2)
+        perr    = np.maximum(1.0 - np.max(post, axis=2), 10.0**(-self.max_qual/10.0))
+        quals   = np.clip(np.round(-10.0 * np.log10(perr)), 0, self.max_qual).astype(np.uint8)
+        return self.symbols[calls], quals + 33
+
+    def _format(self, chunks, fmt):
+        """ Format a chunk of read pairs as paired FASTQ or interleaved FASTA """
+        names, (b1, q1), (b2, q2)   = chunks
+        rl      = b1.shape[1]
+        b1, q1, b2, q2  = b1.tostring(), q1.tostring(), b2.tostring(), q2.tostring()
+        if fmt == 'fasta':
+            out = [ ]
+            for i in xrange(len(names)):
+                s   = slice(i * rl, (i + 1) * rl)
+                out.append(">%s/1\n%s\n>%s/2\n%s\n" % (names[i], b1[s], names[i], b2[s]))
+            return [ ''.join(out) ]
+        out1, out2  = [ ], [ ]
+        for i in xrange(len(names)):
+            s   = slice(i * rl, (i + 1) * rl)
+            out1.append("@%s/1\n%s\n+\n%s\n" % (names[i], b1[s], q1[s]))
+            out2.append("@%s/2\n%s\n+\n%s\n" % (names[i], b2[s], q2[s]))
+        return [ ''.join(out1), ''.join(out2) ]
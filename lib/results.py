@@ -0,0 +1,174 @@
+import      os
+import      glob
+import      socket
+import      time
+import      fcntl
+import      numpy       as      np
+
+# Columns of the results, the grid parameters are parsed from names like T_ulen_unr_rep or D_d1_d2_rep:
+RECORD  = np.dtype([
+    ('name',        'S64'),
+    ('status',      '<i4'),
+    ('nmut',        '<i4'),
+    ('targ_len',    '<i4'),
+    ('cons_len',    '<i4'),
+    ('seq_ident',   '<f8'),
+    ('p1',          '<i8'),
+    ('p2',          '<i8'),
+    ('rep',         '<i4'),
+    ('stamp',       '<f8'),
+])
+
+MERGED  = 'results.npz'
+MERGING = '.merging'
+LOCK    = 'merge.lock'
+
+def grid_params(name):
+    """ Parse the grid parameters and the replicate from an experiment name, -1 if missing """
+    tmp = name.split('_')
+    if len(tmp) != 4:
+        return -1, -1, -1
+    try:
+        return int(tmp[1]), int(tmp[2]), int(tmp[3])
+    except ValueError:
+        return -1, -1, -1
+
+def make_record(name, status, nmut, targ_len, cons_len, seq_ident, stamp=None):
+    """ Build a single result record, stamped with the time of saving """
+    p1, p2, rep = grid_params(name)
+    if stamp is None:
+        stamp   = time.time()
+    return np.array([ (name, status, nmut, targ_len, cons_len, seq_ident, p1, p2, rep, stamp) ], dtype=RECORD)
+
+def is_store(sdir):
+    """ Check whether a directory holds a results store """
+    return os.path.exists(os.path.join(sdir, MERGED)) or len(_segments(sdir)) > 0
+
+def _segments(sdir):
+    """ List the segment files of a store, including the segments of an interrupted merge """
+    return sorted(glob.glob(os.path.join(sdir, "seg_*.bin")) + glob.glob(os.path.join(sdir, "seg_*" + MERGING)))
+
+def _read_segment(fname):
+    """ Read the complete records of a segment, a record cut short by a crash is dropped """
+    data    = open(fname, 'rb').read()
+    n       = len(data) // RECORD.itemsize
+    return np.frombuffer(data[:n * RECORD.itemsize], dtype=RECORD)
+
+def _latest(records):
+    """ Keep the latest record of every experiment, as reruns append new results """
+    if len(records) == 0:
+        return records
+    latest      = records[np.argsort(records['stamp'], kind='mergesort')[::-1]]
+    _, first    = np.unique(latest['name'], return_index=True)
+    return latest[np.sort(first)][::-1]
+
+def load(sdir):
+    """ Load all results of a store as a record array """
+    return _load(sdir, _segments(sdir))
+
+def _load(sdir, segs):
+    """ Load the merged results and the specified segments of a store """
+    parts   = [ ]
+    merged  = os.path.join(sdir, MERGED)
+    if os.path.exists(merged):
+        parts.append(np.load(merged)['results'])
+    for seg in segs:
+        parts.append(_read_segment(seg))
+    if len(parts) == 0:
+        return np.zeros(0, dtype=RECORD)
+    return _latest(np.concatenate(parts))
+
+def load_out_files(sdir, strict=True):
+    """ Load the results saved as .out files, skipping malformed ones unless strict, as results
+        still being written look malformed while polling """
+    records = [ ]
+    for fname in glob.iglob(os.path.join(sdir, "*.out")):
+        tmp = file(fname).readlines()
+        try:
+            if len(tmp) != 1 or len(tmp[0].split()) != 6:
+                raise ValueError("Malformed result file: %s" % fname)
+            tmp = tmp[0].split()
+            records.append(make_record(tmp[0], int(tmp[1]), int(tmp[2]), int(tmp[3]), int(tmp[4]), float(tmp[5]), os.path.getmtime(fname)))
+        except ValueError:
+            if strict:
+                raise ValueError("Malformed result file: %s" % fname)
+    if len(records) == 0:
+        return np.zeros(0, dtype=RECORD)
+    return np.concatenate(records)
+
+def load_any(sdir, strict=True):
+    """ Load the results of a directory from the store if present, otherwise from the .out files """
+    if is_store(sdir):
+        return load(sdir)
+    return load_out_files(sdir, strict)
+
+def merge(sdir):
+    """ Merge the segments into the columnar file, return the number of results """
+    # Concurrent merges would take over each other's moved segments, so they run one at a time:
+    lock    = open(os.path.join(sdir, LOCK), 'a')
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    try:
+        return _merge(sdir)
+    finally:
+        lock.close()
+
+def _merge(sdir):
+    """ Merge the segments while holding the merge lock of the store """
+    # Move the segments out of the way first, writers appending meanwhile start new ones:
+    segs    = [ ]
+    for seg in _segments(sdir):
+        if not seg.endswith(MERGING):
+            moved   = "%s.%d%s" % (seg, os.getpid(), MERGING)
+            os.rename(seg, moved)
+            seg     = moved
+        segs.append(seg)
+    # Wait for the appends which locked a segment before it was moved:
+    for seg in segs:
+        fh  = open(seg, 'rb')
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        fh.close()
+    res     = _load(sdir, segs)
+    merged  = os.path.join(sdir, MERGED)
+    tmp     = os.path.join(sdir, "tmp_%s_%d.npz" % (socket.gethostname(), os.getpid()))
+    fh      = open(tmp, 'wb')
+    np.savez(fh, results=res)
+    fh.close()
+    os.rename(tmp, merged)
+    for seg in segs:
+        os.remove(seg)
+    return len(res)
+
+class ResultStore:
+    """ Append results to the binary segment of this process """
+    def __init__(self, sdir):
+        if not os.path.isdir(sdir):
+            try:
+                os.makedirs(sdir)
+            except OSError:
+                # Another writer might have created it:
+                if not os.path.isdir(sdir):
+                    raise
+        self.sdir   = sdir
+
+    def segment(self):
+        """ Get the segment of the current process, which might be a forked worker """
+        return os.path.join(self.sdir, "seg_%s_%d.bin" % (socket.gethostname(), os.getpid()))
+
+    def append(self, name, status, nmut, targ_len, cons_len, seq_ident):
+        """ Append a result, the segment is reopened and locked for every record so merging can move it """
+        seg     = self.segment()
+        while True:
+            fh  = open(seg, 'ab')
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            # Start a new segment if merging moved this one before it was locked:
+            st  = os.fstat(fh.fileno())
+            try:
+                cur = os.stat(seg)
+            except OSError:
+                cur = None
+            if cur is not None and (cur.st_dev, cur.st_ino) == (st.st_dev, st.st_ino):
+                break
+            fh.close()
+        fh.write(make_record(name, status, nmut, targ_len, cons_len, seq_ident).tostring())
+        fh.flush()
+        fh.close()
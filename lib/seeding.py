@@ -0,0 +1,34 @@
+import      hashlib
+import      numpy       as      np
+
+# Stages of a simulated experiment drawing random numbers:
+STAGES  = ('target', 'pcr', 'mutsim', 'reads')
+
+def _digest(keys):
+    """ Hash keys like a campaign hash, an experiment name and a stage """
+    return hashlib.sha1('|'.join(str(k) for k in keys)).digest()
+
+def derive_seed(*keys):
+    """ Derive a seed from keys, the whole SHA-1 digest in hexadecimal, so seeds of a campaign do not collide """
+    return _digest(keys).encode('hex')
+
+def stream(*keys):
+    """ Get a random stream for the keys, independent of the streams of other keys """
+    return np.random.RandomState(np.frombuffer(_digest(keys), dtype=np.uint32))
+
+def external_seed(rng):
+    """ Draw a seed for an external program, like R or simNGS, from a random stream """
+    return rng.randint(1, 2**31 - 1)
+
+class Streams:
+    """ Random streams of the stages of an experiment derived from its full seed, the global generator if unseeded """
+    def __init__(self, seed=None):
+        self.seed   = seed
+
+    def get(self, stage):
+        """ Get a fresh random stream for a stage """
+        if stage not in STAGES:
+            raise ValueError("Unknown random stream: %s" % stage)
+        if self.seed is None:
+            return np.random
+        return stream(self.seed, stage)
@@ -1,11 +1,29 @@
 import      utils       as      u
+import      seeding
 import      os 
 import      dendropy
+import      numpy       as      np
+
+# Available PCR simulation backends:
+BACKENDS = ('numpy', 'R')
+
+# Checkpointable stages of the numpy backend and the parameters they depend on,
+# the last stage holds the mutated molecules shared by a row of dil_sim grid cells:
+STAGES          = ('mut', 'cln', 'row')
+STAGE_PARAMS    = {
+    'mut':  ('init_popsize', 'pcr_eff', 'nr_cycles_mut'),
+    'cln':  ('dilf_after_mut', 'nr_cycles_cln'),
+    'row':  (),
+}
 
 class SimPcrDil:
     """ Simulate PCR amplifications and dilutions """
-    def __init__(self, name, init_popsize, pcr_eff, nr_cycles_mut, dilf_after_mut, nr_cycles_cln, dilf_after_cln, nr_cycles_cov, total_cov, sample_size_mut, path, log, rdir='.', clean=True, mut_only=False):
+    def __init__(self, name, init_popsize, pcr_eff, nr_cycles_mut, dilf_after_mut, nr_cycles_cln, dilf_after_cln, nr_cycles_cov, total_cov, sample_size_mut, path, log, rdir='.', clean=True, mut_only=False, backend='R', rng=np.random):
+        if backend not in BACKENDS:
+            raise ValueError("Unknown PCR simulation backend: %s" % backend)
         self.log            = log
+        self.backend        = backend
+        self.rng            = rng
         self.name           = name
         self.init_popsize   = init_popsize
         self.pcr_eff        = pcr_eff
@@ -25,10 +43,17 @@ class SimPcrDil:
             self.mut_only   = 1
         self.out_nwk        = os.path.join(self.rdir, self.name + ".nwk")
         self.out_cov        = os.path.join(self.rdir, self.name + ".cov")
-        self._check_script()
+        if self.backend == 'R':
+            u.check_cmd('R')
+            self._check_script()
+
+    def simulate(self, state=None):
+        """ Run NG-SAM simulation, optionally continuing from a saved stage """
+        if self.backend == 'numpy':
+            return self._simulate_numpy(state)
+        if state is not None:
+            self.log.fatal("The R backend cannot continue from a saved stage!")
 
-    def simulate(self):
-        """ Run NG-SAM simulation """
         ret     = 256
         count   = 0 
         while True:
@@ -47,6 +72,143 @@ class SimPcrDil:
         if self.clean:
             self._cleanup()
         return res
+
+    def sim_stage(self, stage, state=None):
+        """ Simulate the experiment up to the end of a PCR stage and return the state """
+        if stage not in STAGES[:-1]:
+            raise ValueError("Unknown PCR stage: %s" % stage)
+        if state is None:
+            state   = self._sim_mut()
+        self._check_state(state)
+        if stage == 'cln' and state['stage'] == 'mut':
+            state   = self._sim_cln(state)
+        return state
+
+    def _sim_mut(self):
+        """ Simulate the trajectory of the mutagenic PCR """
+        traj_mut    = PcrCoal(self.init_popsize, self.pcr_eff, self.nr_cycles_mut, self.rng).sample_trs()
+        state       = {'stage': 'mut', 'traj_mut': traj_mut}
+        self._record_params(state, 'mut')
+        return state
+
+    def _sim_cln(self, state):
+        """ Dilute the mutagenic PCR product and simulate the cleanup PCR """
+        state           = dict(state)
+        state['stage']  = 'cln'
+        init_size_cln   = self.rng.poisson(state['traj_mut'][-1] / float(self.dilf_after_mut))
+        state['size_cln'] = 0
+        if init_size_cln > 0:
+            state['size_cln'] = PcrCoal(init_size_cln, self.pcr_eff, self.nr_cycles_cln, self.rng).sample_trs()[-1]
+        self._record_params(state, 'cln')
+        return state
+
+    def sim_row(self, state, dilfs, ms, root_seq):
+        """ Draw the final dilutions of a row of grid cells continuing from a cleanup PCR stage,
+            then sample the genealogy of the largest final population and mutate its molecules """
+        self._check_state(state)
+        if state['stage'] != 'cln':
+            raise ValueError("A row is simulated from the cleanup PCR stage!")
+        state           = dict(state)
+        state['stage']  = 'row'
+        sizes           = [ self.rng.poisson(state['size_cln'] / float(d)) for d in dilfs ]
+        state['dilfs']  = np.array(dilfs, dtype=float)
+        state['final_sizes'] = np.array(sizes, dtype=np.int64)
+        # Any subset of the molecules is a uniform sample, so the cells take
+        # the first molecules of the largest sample:
+        nr_mols         = min(max(sizes + [ 0 ]), state['traj_mut'][-1])
+        state['seqs']   = np.array([ ], dtype=str)
+        if nr_mols > 0:
+            pcoal_mut   = PcrCoal(self.init_popsize, self.pcr_eff, self.nr_cycles_mut, self.rng)
+            nwk, tips   = self._sample_tnt(pcoal_mut, nr_mols, state['traj_mut'])
+            ms.sim(self._parse_tree(nwk), root_seq, self.rng)
+            seqs        = ms.get_tips(tips)
+            state['seqs'] = np.array([ seqs[t] for t in tips ], dtype=str)
+        self._record_params(state, 'row')
+        return state
+
+    def _simulate_row(self, state):
+        """ Simulate the coverage PCR of a grid cell from the saved molecules of its row """
+        self._check_state(state)
+        idx         = np.where(state['dilfs'] == float(self.dilf_after_cln))[0]
+        if len(idx) == 0:
+            self.log.fatal("Saved stage row has no cell with dilution factor %s!" % self.dilf_after_cln)
+        final_size  = min(int(state['final_sizes'][idx[0]]), len(state['seqs']))
+        if final_size == 0:
+            return {'cov': {}, 'cov_perc': {}}
+        fams        = PcrCoal(final_size, self.pcr_eff, self.nr_cycles_cov, self.rng).sample_families()
+        cov_perc    = fams / float(np.sum(fams))
+        cov         = { }
+        perc        = { }
+        seqs        = { }
+        for i in xrange(final_size):
+            tip         = "t%d" % (i + 1)
+            cov[tip]    = int(cov_perc[i] * self.total_cov)
+            perc[tip]   = cov_perc[i]
+            seqs[tip]   = str(state['seqs'][i])
+        return {'cov': cov, 'cov_perc': perc, 'seqs': seqs}
+
+    def _record_params(self, state, stage):
+        """ Record the parameters a stage was simulated with """
+        for param in STAGE_PARAMS[stage]:
+            state[param]    = getattr(self, param)
+
+    def _check_state(self, state):
+        """ Check that a saved stage was simulated with the same parameters """
+        for stage in STAGES[:STAGES.index(state['stage']) + 1]:
+            for param in STAGE_PARAMS[stage]:
+                if state[param] != getattr(self, param):
+                    self.log.fatal("Saved stage %s has a different %s!" % (state['stage'], param))
+
+    def _simulate_numpy(self, state=None):
+        """ Simulate the experiment in-process, following pcr_coal.R """
+        # The molecules of a saved row are already mutated:
+        if state is not None and state['stage'] == 'row':
+            return self._simulate_row(state)
+        # Simulate the trajectory of the mutagenic PCR and the cleanup PCR,
+        # unless continuing from a saved stage:
+        if self.mut_only:
+            state   = self.sim_stage('mut', state)
+        else:
+            state   = self.sim_stage('cln', state)
+        traj_mut    = state['traj_mut']
+        pcoal_mut   = PcrCoal(self.init_popsize, self.pcr_eff, self.nr_cycles_mut, self.rng)
+        if self.mut_only:
+            nwk, tips   = self._sample_tnt(pcoal_mut, self.sample_size_mut, traj_mut)
+            return {'cov': {}, 'cov_perc': {}, 'tree': self._parse_tree(nwk)}
+
+        # No molecules survived the first dilution:
+        if state['size_cln'] == 0:
+            return {'cov': {}, 'cov_perc': {}}
+
+        # Dilute after the cleanup PCR:
+        final_size  = self.rng.poisson(state['size_cln'] / float(self.dilf_after_cln))
+        if final_size == 0:
+            return {'cov': {}, 'cov_perc': {}}
+
+        # The surviving molecules are a uniform sample from the mutagenic
+        # PCR product, so their genealogy is sampled directly:
+        nwk, tips   = self._sample_tnt(pcoal_mut, final_size, traj_mut)
+        final_size  = len(tips)
+
+        # Simulate coverage PCR:
+        fams        = PcrCoal(final_size, self.pcr_eff, self.nr_cycles_cov, self.rng).sample_families()
+        cov_perc    = fams / float(np.sum(fams))
+        cov         = { }
+        perc        = { }
+        for i in xrange(final_size):
+            cov[tips[i]]    = int(cov_perc[i] * self.total_cov)
+            perc[tips[i]]   = cov_perc[i]
+        return {'cov': cov, 'cov_perc': perc, 'tree': self._parse_tree(nwk)}
+
+    def _sample_tnt(self, pcoal, sample_size, traj):
+        """ Sample a genealogy, capping the sample size at the final population of the mutagenic PCR """
+        if traj[-1] < 1:
+            self.log.fatal("Failed to simulate experiment: no molecules after the mutagenic PCR (init_popsize: %s, pcr_eff: %s, nr_cycles_mut: %s)!" % (self.init_popsize, self.pcr_eff, self.nr_cycles_mut))
+        return pcoal.sample_tnt(min(sample_size, traj[-1]), traj)
+
+    def _parse_tree(self, nwk):
+        """ Build a dendropy tree from a newick string """
+        return dendropy.Tree.get_from_string(nwk, schema='newick', as_rooted=True)
            
     def _cleanup(self):
         """ Remove pcr_coal.R output """
@@ -58,11 +220,14 @@ class SimPcrDil:
     def _harness_results(self):
         res = {}
         cov = {}
+        perc= {}
         for line in file(self.out_cov):
             name, cv    = line.split()
             cov[name]   = int(float(cv) * self.total_cov)
-        res['cov']  = cov
-        if len(res['cov']) > 0:
+            perc[name]  = float(cv)
+        res['cov']      = cov
+        res['cov_perc'] = perc
+        if len(res['cov']) > 0 or self.mut_only:
             res['tree'] = dendropy.Tree.get_from_path(self.out_nwk, schema='newick', as_rooted=True)
         return res
 
@@ -82,6 +247,8 @@ class SimPcrDil:
             self.nr_cycles_cov,
             self.sample_size_mut,
             self.mut_only,
+            # R draws from its own generator, seeded from the stream:
+            seeding.external_seed(self.rng),
         ]
         cmd = self.script
         for arg in args:
@@ -95,3 +262,94 @@ class SimPcrDil:
         ret = os.system(cmd)
         os.chdir(old_wd)
         return ret
+
+def save_state(state, fname):
+    """ Save a simulation stage to a file """
+    fh  = open(fname + ".tmp", "wb")
+    np.savez_compressed(fh, **state)
+    fh.flush()
+    fh.close()
+    os.rename(fname + ".tmp", fname)
+
+def load_state(fname):
+    """ Load a simulation stage from a file """
+    tmp     = np.load(fname)
+    state   = { }
+    for k in tmp.files:
+        v   = tmp[k]
+        if v.ndim == 0:
+            v   = v.item()
+        state[k]    = v
+    tmp.close()
+    return state
+
+class PcrCoal:
+    """ Simulate PCR amplification and sample genealogies in the manner of pcrcoal """
+    def __init__(self, initial_size, pcr_eff, nr_cycles, rng=np.random):
+        self.initial_size   = int(initial_size)
+        self.pcr_eff        = pcr_eff
+        self.nr_cycles      = nr_cycles
+        self.rng            = rng
+
+    def sample_trs(self):
+        """ Sample the number of molecules after each cycle """
+        traj    = np.zeros(self.nr_cycles + 1, dtype=np.int64)
+        traj[0] = self.initial_size
+        for i in xrange(self.nr_cycles):
+            traj[i+1]   = traj[i] + self.rng.binomial(traj[i], self.pcr_eff)
+        return traj
+
+    def sample_families(self):
+        """ Sample the final number of descendants of every initial molecule """
+        fams    = np.ones(self.initial_size, dtype=np.int64)
+        for i in xrange(self.nr_cycles):
+            fams    += self.rng.binomial(fams, self.pcr_eff)
+        return fams
+
+    def sample_tnt(self, sample_size, traj):
+        """ Sample the genealogy of molecules from the final population """
+        if sample_size > traj[-1]:
+            raise ValueError("Sample size is larger than the final population!")
+        tips        = [ "t%d" % (i + 1) for i in xrange(sample_size) ]
+        # Active lineages as newick subtrees with node heights in cycles:
+        lineages    = [ (t, 0) for t in tips ]
+        for k in xrange(self.nr_cycles, 0, -1):
+            if len(lineages) == 1:
+                break
+            # Place lineages on random molecules after cycle k. Molecules
+            # beyond the size before the cycle are copies of the originals:
+            size_before = traj[k-1]
+            pos         = sample_distinct(traj[k], len(lineages), self.rng)
+            parents     = np.where(pos >= size_before, pos - size_before, pos)
+            groups      = { }
+            for i in xrange(len(lineages)):
+                groups.setdefault(parents[i], []).append(lineages[i])
+            height      = self.nr_cycles - k + 1
+            lineages    = [ ]
+            for group in groups.itervalues():
+                if len(group) == 1:
+                    lineages.append(group[0])
+                else:
+                    lineages.append( (self._join(group, height), height) )
+        # Join the remaining lineages at the start of the PCR:
+        if len(lineages) == 1:
+            nwk = lineages[0][0]
+        else:
+            nwk = self._join(lineages, self.nr_cycles)
+        return nwk + ";", tips
+
+    def _join(self, lineages, height):
+        """ Join lineages under a node of the specified height """
+        return "(" + ",".join([ "%s:%d" % (n, height - h) for n, h in lineages ]) + ")"
+
+def sample_distinct(n, m, rng=np.random):
+    """ Sample m distinct integers from [0, n) in random order """
+    if m > n:
+        raise ValueError("Cannot sample %d distinct values from %d!" % (m, n))
+    if n <= 4 * m:
+        return rng.permutation(n)[:m]
+    res = np.unique(rng.randint(0, n, m))
+    while len(res) < m:
+        res = np.unique(np.concatenate( (res, rng.randint(0, n, m - len(res))) ))
+    rng.shuffle(res)
+    return res
@@ -1,15 +1,24 @@
 
 import      utils       as      u
+import      seeding
 import      os 
+import      string
+import      subprocess  as      sp
+import      numpy       as      np
+
+# Complement table for reverse complementing fragments:
+COMPLEMENT  = string.maketrans('ATGCatgc', 'TACGtacg')
 
 class SimNGS:
     """ simulate Illumina sequencing using simNGS """
-    def __init__(self, run_file, read_length, insert_size, log, rts):
+    def __init__(self, run_file, read_length, insert_size, log, rts, ins_sd=20.0, rng=np.random):
         self.fq_tmp     = 'tmp'
         self.log        = log
+        self.rng        = rng
         self.run_file   = run_file
         self.read_length= read_length
         self.insert_size= insert_size
+        self.ins_sd     = ins_sd
         self.isize      = insert_size - 2 * read_length
         self.sim_cmd    = self._build_sim_cmd()
         self.rts        = rts
@@ -29,6 +38,44 @@ class SimNGS:
             self.log.fatal("Failed to simulate sequencing for %s" % name)
         os.unlink(ref)
 
+    def sim_batch(self, seqs, prefix="reads"):
+        """ Simulate from all sequences in one simNGS run, seqs maps names to (sequence, coverage) """
+        prefix  = os.path.basename(self.rts.tempfile(prefix))
+        fqs     = [ ]
+        for end in ('end1', 'end2'):
+            fq  = os.path.join(self.rts.base, "%s_%s.fq" % (prefix, end))
+            self.rts.register(fq)
+            fqs.append(fq)
+        # simNGS draws the sequencing errors from its own generator, seeded from the stream:
+        seed    = seeding.external_seed(self.rng)
+        cmd     = ["simNGS", "-n", str(self.read_length), "-p", "paired", "-o", "fastq", "-O", prefix, "-s", str(seed), self.run_file]
+        devnull = open(os.devnull, "w")
+        proc    = sp.Popen(cmd, stdin=sp.PIPE, stderr=devnull, cwd=self.rts.base)
+        # Stream the fragments of every sequence into simNGS:
+        for name, (seq, cov) in seqs.iteritems():
+            for chunk in self._build_lib(name, seq, cov):
+                proc.stdin.write(chunk)
+        proc.stdin.close()
+        ret     = proc.wait()
+        devnull.close()
+        if ret != 0:
+            self.log.fatal("Failed to simulate sequencing!")
+        return fqs
+
+    def _build_lib(self, name, seq, cov, chunk_size=10000):
+        """ Sample library fragments from a sequence in the manner of simLibrary, in chunks """
+        nr_frags    = nr_fragments(len(seq), cov, self.read_length)
+        for offset in xrange(0, nr_frags, chunk_size):
+            n           = min(chunk_size, nr_frags - offset)
+            starts, lengths, strands    = sample_fragments(len(seq), n, self.read_length, self.insert_size, self.ins_sd, self.rng)
+            frags       = [ ]
+            for i in xrange(n):
+                frag    = seq[starts[i]:starts[i] + lengths[i]]
+                if strands[i]:
+                    frag    = frag[::-1].translate(COMPLEMENT)
+                frags.append(">%s_%d\n%s\n" % (name, offset + i, frag))
+            yield ''.join(frags)
+
     def _build_sim_cmd(self):
         cmd = "simNGS -n %d -p paired -o fastq -O %s %s 2>/dev/null; cat tmp_end1.fq >> end1.fq; cat tmp_end2.fq >> end2.fq; rm tmp_end?.fq" % (self.read_length, self.fq_tmp, self.run_file)
         return cmd
@@ -37,3 +84,14 @@ class SimNGS:
         cmd = "cd %s; simLibrary -r %d -i %d -x %d %s 2>/dev/null" % (self.rts.base, self.read_length, self.isize, cov, ref)
         return cmd
 
+def nr_fragments(seq_len, cov, read_length):
+    """ Number of paired fragments giving the specified read coverage """
+    return int(cov * seq_len / (2.0 * read_length))
+
+def sample_fragments(seq_len, n, read_length, insert_size, ins_sd, rng=np.random):
+    """ Sample fragment starts, lengths and strands (True: reverse) """
+    lengths     = rng.normal(insert_size, ins_sd, n).round().astype(int)
+    lengths     = np.clip(lengths, 2 * read_length, seq_len)
+    starts      = (rng.random_sample(n) * (seq_len - lengths + 1)).astype(int)
+    strands     = rng.random_sample(n) < 0.5
+    return starts, lengths, strands
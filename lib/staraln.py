@@ -0,0 +1,223 @@
+import      utils       as      u
+import      bandaln
+import      numpy       as      np
+from        Bio.Align   import  MultipleSeqAlignment
+from        Bio.SeqRecord   import  SeqRecord
+from        Bio.Seq     import  Seq
+
+# Traceback codes, positive codes are horizontal gap lengths:
+DIAG    = 0
+UP      = -1
+STOP    = -2
+
+class StarAligner:
+    """ Align contigs to a growing anchor and merge the pairwise alignments """
+    def __init__(self, log, match=5, mismatch=-4, gap=-8, k=12, min_band=32, max_band=1024, max_kmer_hits=200, min_overlap=50, min_identity=0.8, max_repeat=0.5, fallback=None):
+        if max_band < 2 * min_band + 1 or max_band > np.iinfo(np.int16).max:
+            raise ValueError("The maximal band width must hold the initial band and fit the traceback!")
+        self.log            = log
+        self.match          = match
+        self.mismatch       = mismatch
+        self.gap            = gap
+        self.k              = k
+        self.min_band       = min_band
+        self.max_band       = max_band
+        self.max_kmer_hits  = max_kmer_hits
+        self.min_overlap    = min_overlap
+        self.min_identity   = min_identity
+        self.max_repeat     = max_repeat
+        self.fallback       = fallback
+
+    def align_contigs(self, contigs):
+        """ Calculate multiple alignment of contigs, in the format of Muscle.align_contigs """
+        if len(contigs) == 0:
+            return None
+        names   = sorted(contigs.iterkeys(), key=lambda n: (-len(contigs[n]), n))
+        # The longest contig is the initial anchor:
+        anchor  = contigs[names[0]]
+        left    = 0
+        pairs   = { names[0]: (0, 0, anchor, anchor) }
+        pending = names[1:]
+        while len(pending) > 0:
+            deferred    = [ ]
+            for name in pending:
+                res = self._align_pair(contigs[name], anchor)
+                if res is None:
+                    deferred.append(name)
+                    continue
+                a_gapped, c_gapped, start, pre, post  = res
+                # Grow the anchor by the overhanging ends of the contig:
+                anchor          = pre + anchor + post
+                left            += len(pre)
+                pairs[name]     = (left, start, a_gapped, c_gapped)
+            # Contigs still without a reliable overlap once the anchor stopped growing are left unaligned:
+            if len(deferred) == len(pending):
+                break
+            pending = deferred
+        if len(pending) > 0:
+            if self.fallback is not None:
+                self.log.log("Star alignment left %d contigs unaligned, aligning all contigs by the fallback aligner." % len(pending))
+                return self.fallback.align_contigs(contigs)
+            self.log.log("Star alignment left %d contigs unaligned, dropping them: %s" % (len(pending), ' '.join(sorted(pending))))
+            names   = [ name for name in names if name not in pending ]
+        return self._merge(names, pairs, left, len(anchor))
+
+    def _align_pair(self, contig, anchor):
+        """ Align a contig to the anchor, returning the gapped pair, its start and the overhangs """
+        c1, c2  = bandaln.encode(contig), bandaln.encode(anchor)
+        n, m    = len(c1), len(c2)
+        support = bandaln.diagonal_support(c1, c2, self.k, self.max_kmer_hits)
+        if support is None:
+            return None
+        best    = int(np.argmax(support))
+        diag    = best - n
+        # Repeats supporting a distant diagonal nearly as well could place the contig on a false overlap:
+        other   = support.copy()
+        other[max(best - self.min_band, 0):best + self.min_band + 1]  = 0
+        if np.max(other) > self.max_repeat * support[best]:
+            return None
+        lo, hi  = diag - self.min_band, diag + self.min_band
+        # Widen the band until the alignment does not touch its edges, up to the maximal width:
+        while True:
+            lo, hi  = max(lo, -n), min(hi, m)
+            path, edge  = self._overlap(c1, c2, lo, hi)
+            width   = hi - lo
+            grow    = min(width, (self.max_band - width - 1) // 2)
+            if not edge or grow <= 0:
+                break
+            lo, hi  = lo - grow, hi + grow
+        (i0, j0), (i1, j1), ops = path
+        # The overlap must reach an end of both the contig and the anchor on either side:
+        if not ((i0 == 0 or j0 == 0) and (i1 == n or j1 == m)):
+            return None
+        a_gapped, c_gapped  = [ ], [ ]
+        i, j    = i0, j0
+        matches = 0
+        for op in ops:
+            if op == DIAG:
+                a_gapped.append(anchor[j])
+                c_gapped.append(contig[i])
+                matches += c1[i] == c2[j] and c1[i] >= 0
+                i, j    = i + 1, j + 1
+            elif op == UP:
+                a_gapped.append('-')
+                c_gapped.append(contig[i])
+                i       += 1
+            else:
+                a_gapped.append(anchor[j])
+                c_gapped.append('-')
+                j       += 1
+        # Short or divergent overlaps would grow the anchor by the unaligned parts of the contig:
+        if len(ops) < min(self.min_overlap, n) or matches < self.min_identity * len(ops):
+            return None
+        # Overhanging ends of the contig align to themselves once added to the anchor:
+        pre, post   = contig[:i0], contig[i1:]
+        a_gapped    = pre + ''.join(a_gapped) + post
+        c_gapped    = pre + ''.join(c_gapped) + post
+        return a_gapped, c_gapped, j0, pre, post
+
+    def _overlap(self, c1, c2, lo, hi):
+        """ Overlap alignment with free end gaps restricted to diagonals lo <= j - i <= hi """
+        n, m    = len(c1), len(c2)
+        width   = hi - lo + 1
+        g       = self.gap
+        ks      = np.arange(width)
+        NEG     = bandaln.NEG_INF
+        # Row i = 0: leading gaps are free.
+        j       = lo + ks
+        H_prev  = np.where((j >= 0) & (j <= m), 0, NEG).astype(np.int64)
+        H_prev  = np.append(H_prev, NEG)
+        ptr     = np.zeros((n + 1, width), dtype=np.int16) + STOP
+        best    = (NEG, 0, 0)
+
+        for i in xrange(1, n + 1):
+            j       = i + lo + ks
+            valid   = (j >= 0) & (j <= m)
+            jj      = np.clip(j - 1, 0, m - 1)
+            same    = (c2[jj] == c1[i-1]) & (c1[i-1] >= 0)
+            diag    = H_prev[:width] + np.where(same, self.match, self.mismatch)
+            up      = H_prev[1:] + g
+            H0      = np.maximum(diag, up)
+            P       = np.where(diag >= up, DIAG, UP)
+            H0[~valid]  = NEG
+            border      = j == 0
+            H0[border]  = 0
+            P[border]   = STOP
+            # Horizontal gaps by a running maximum over the row:
+            src     = H0 - ks * g
+            run     = np.maximum.accumulate(src)
+            E       = np.zeros(width, dtype=np.int64) + NEG
+            E[1:]   = run[:-1] + ks[1:] * g
+            idx     = np.where(src >= run, ks, 0)
+            idx     = np.maximum.accumulate(idx)
+            use_e   = (E > H0) & valid
+            from_k  = idx[np.maximum(ks - 1, 0)]
+            H       = np.where(use_e, E, H0)
+            P       = np.where(use_e, ks - from_k, P)
+            ptr[i]  = P
+            # Trailing gaps are free, so alignments end in the last row or column:
+            k_last  = m - i - lo
+            if 0 <= k_last < width and H[k_last] > best[0]:
+                best    = (H[k_last], i, k_last)
+            if i == n:
+                k_top   = np.argmax(np.where(valid, H, NEG))
+                if H[k_top] > best[0]:
+                    best    = (H[k_top], i, k_top)
+            H_prev[:width]  = H
+            H_prev[width]   = NEG
+
+        # Trace back to the first row or column:
+        _, i, k = best
+        end     = (i, i + lo + k)
+        ops     = [ ]
+        edge    = False
+        while True:
+            edge    = edge or (k == 0 and lo > -n) or (k == width - 1 and hi < m)
+            p       = ptr[i, k]
+            if p == STOP:
+                break
+            if p == DIAG:
+                ops.append(DIAG)
+                i   -= 1
+            elif p == UP:
+                ops.append(UP)
+                i   -= 1
+                k   += 1
+            else:
+                ops.extend([ 1 ] * p)
+                k   -= p
+        ops.reverse()
+        return ((i, i + lo + k), end, ops), edge
+
+    def _merge(self, names, pairs, left, anchor_len):
+        """ Merge the pairwise alignments to the final anchor into a multiple alignment """
+        chars   = { }
+        inserts = { }
+        ins_len = np.zeros(anchor_len + 1, dtype=int)
+        for name in names:
+            grown, start, a_gapped, c_gapped    = pairs[name]
+            # Shift by the growth of the anchor after this contig was aligned:
+            pos     = start + left - grown
+            row     = [ '-' ] * anchor_len
+            ins     = { }
+            for a, c in zip(a_gapped, c_gapped):
+                if a == '-':
+                    ins[pos]    = ins.get(pos, '') + c
+                else:
+                    row[pos]    = c
+                    pos         += 1
+            for p, s in ins.iteritems():
+                ins_len[p]  = max(ins_len[p], len(s))
+            chars[name]     = row
+            inserts[name]   = ins
+        records = [ ]
+        for name in names:
+            row, ins    = chars[name], inserts[name]
+            out         = [ ]
+            for p in xrange(anchor_len + 1):
+                if ins_len[p] > 0:
+                    out.append(ins.get(p, '').ljust(ins_len[p], '-'))
+                if p < anchor_len:
+                    out.append(row[p])
+            records.append(SeqRecord(Seq(''.join(out)), id=name, description=''))
+        return MultipleSeqAlignment(records)
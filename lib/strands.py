@@ -0,0 +1,37 @@
+import      utils       as      u
+
+class StrandVote:
+    """ Decide the strand of sequences relative to an anchor by voting on shared k-mers """
+    def __init__(self, k=15, min_votes=10, min_ratio=4.0):
+        self.k          = k
+        self.min_votes  = min_votes
+        self.min_ratio  = min_ratio
+
+    def _kmers(self, seq):
+        """ Get the set of k-mers in a sequence """
+        k   = self.k
+        return set( seq[i:i+k] for i in xrange(len(seq) - k + 1) )
+
+    def vote(self, anchor, seqs):
+        """ Vote on the strands, True means reverse complement, None means undecided """
+        anchor_kmers    = self._kmers(anchor)
+        res             = { }
+        for name, seq in seqs.iteritems():
+            kmers   = self._kmers(seq)
+            fwd     = len(kmers & anchor_kmers)
+            rev     = len(self._kmers(u.revcomp(seq)) & anchor_kmers)
+            if max(fwd, rev) < self.min_votes or max(fwd, rev) < self.min_ratio * min(fwd, rev):
+                res[name]   = None
+            else:
+                res[name]   = rev > fwd
+        return res
+
+def orient(anchor, seqs, exn, voter=None):
+    """ Decide the strands of sequences against an anchor, using exonerate for undecided ones """
+    res     = dict( (name, None) for name in seqs.iterkeys() )
+    if voter is not None:
+        res = voter.vote(anchor, seqs)
+    undecided   = dict( (name, seqs[name]) for name, s in res.iteritems() if s is None )
+    if len(undecided) > 0:
+        res.update(exn.check_strands_batch(anchor, undecided))
+    return res
@@ -2,17 +2,23 @@ import      os
 import      sys
 import      time
 import      copy
+import      shutil
+import      tempfile
+import      resource
 import      subprocess                      as      sp
 from        Bio                             import  SeqIO
 from        Bio                             import  Seq
 from        Bio.Alphabet                    import  generic_dna
-import      matplotlib
-matplotlib.use('Agg')
-from        matplotlib                      import  pyplot          as  plt
 from        collections                     import  defaultdict
-from        matplotlib.backends.backend_pdf import  PdfPages
 import      numpy                           as      np
 
+# Plotting modules, imported by the first Report so the simulations do not load them:
+plt         = None
+PdfPages    = None
+
+# Commands already found in the path:
+_checked_cmds   = set()
+
 class Log:
     """ Logging utility class """
     def __init__(self, fname=None, level=0):
@@ -40,37 +46,185 @@ class Log:
         self.file.write("[%s] %s\n" % (time.strftime("%y-%m-%d %H:%M:%s"), message) )
         sys.exit(1)
 
+# Columns of the stage records of a profile:
+PROFILE_COLUMNS = ('wall', 'cpu', 'child_cpu', 'maxrss_mb', 'child_maxrss_mb', 'io_mb')
+
+def _maxrss_mb(who):
+    """ Peak resident set size in megabytes, ru_maxrss is in kilobytes on Linux """
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+def _reset_hwm():
+    """ Reset the peak resident set size of this process, False where /proc/self/clear_refs is missing """
+    try:
+        fh  = open('/proc/self/clear_refs', 'w')
+        fh.write('5')
+        fh.close()
+    except (IOError, OSError):
+        return False
+    return True
+
+def _hwm_mb():
+    """ Peak resident set size of this process since the last reset in megabytes, VmHWM is in kilobytes """
+    for line in open('/proc/self/status'):
+        if line.startswith('VmHWM:'):
+            return int(line.split()[1]) / 1024.0
+    return None
+
+class Profile:
+    """ Record the time, memory and temporary file output of the stages of an experiment and their inputs """
+    def __init__(self, rts=None):
+        self.rts    = rts
+        self.stages = [ ]
+        self.inputs = [ ]
+        self.current= None
+
+    def _written(self):
+        """ Bytes written to the temporary files so far """
+        if self.rts is None:
+            return 0
+        return self.rts.bytes_written()
+
+    def begin(self, name):
+        """ Start measuring a stage, ending the current one """
+        self.end()
+        self.current    = (name, time.time(), os.times(), self._written(), _reset_hwm())
+
+    def end(self):
+        """ End the current stage: wall time, CPU time of this process and of the waited children, peak RSS of this process
+            during the stage (so far, where the peak cannot be reset), peak RSS of the largest child waited by the process so far,
+            temporary output """
+        if self.current is None:
+            return
+        name, wall, t0, w0, reset   = self.current
+        t1              = os.times()
+        rss             = _hwm_mb() if reset else None
+        if rss is None:
+            rss         = _maxrss_mb(resource.RUSAGE_SELF)
+        self.stages.append((name, (
+            time.time() - wall,
+            (t1[0] + t1[1]) - (t0[0] + t0[1]),
+            (t1[2] + t1[3]) - (t0[2] + t0[3]),
+            rss,
+            _maxrss_mb(resource.RUSAGE_CHILDREN),
+            (self._written() - w0) / float(2**20),
+        )))
+        self.current    = None
+
+    def note(self, key, value):
+        """ Record a stage input """
+        self.inputs.append((key, value))
+
+    def save(self, fname):
+        """ Save the profile as tab separated stage and input records """
+        fh  = open(fname, "w")
+        for name, values in self.stages:
+            fh.write("stage\t%s\t%s\n" % (name, '\t'.join("%.3f" % v for v in values)))
+        for key, value in self.inputs:
+            fh.write("input\t%s\t%s\n" % (key, value))
+        fh.flush()
+        fh.close()
+
+def load_profile(fname):
+    """ Load a saved profile as lists of stage and input records """
+    stages  = [ ]
+    inputs  = [ ]
+    for line in file(fname):
+        tmp = line.rstrip('\n').split('\t')
+        if tmp[0] == 'stage':
+            stages.append((tmp[1], dict(zip(PROFILE_COLUMNS, map(float, tmp[2:])))))
+        elif tmp[0] == 'input':
+            inputs.append((tmp[1], float(tmp[2])))
+        else:
+            raise ValueError("Malformed profile: %s" % fname)
+    return stages, inputs
+
 class Rtemp:
-    """ Utility class handling temporary storage """
-    def __init__(self, base, log, autoclean=False):
+    """ Utility class handling temporary storage, optionally in a size limited RAM backed scratch directory """
+    def __init__(self, base, log, autoclean=False, scratch=None, scratch_mb=None):
         self.log        = log
         self.autoclean  = autoclean
         self.parent     = None
-        self.children   = [ ]
-        self.files      = [ ]
+        self.children   = set()
+        self.files      = set()
+        self.dirs       = set()
+        self.suffixes   = { }
         if os.path.isdir(base) != True:
             log.fatal("The base must be a directory: %s" % base)
         self.base   = os.path.abspath(base)
+        # Directory of the files spilled from the scratch, the base for objects on disk:
+        self.disk   = self.base
+        if scratch != None and os.path.isdir(scratch) != True:
+            log.fatal("The scratch must be a directory: %s" % scratch)
+        # State shared by the tree of subdirectories: live files, bytes of the removed ones and scratch usage.
+        self.pool   = {
+            'files':    set(),
+            'removed':  0,
+            'scratch':  None,
+            'budget':   None,
+            'baseline': 0,
+            'spilled':  0,
+        }
+        if scratch != None:
+            self.pool['scratch']    = os.path.abspath(scratch) + os.sep
+            if scratch_mb != None:
+                # The budget is capped at the available space:
+                used, avail             = self._scratch_fs()
+                self.pool['budget']     = min(scratch_mb * 2**20, avail)
+                self.pool['baseline']   = used
 
     def exists(self, fname):
         """ Check wheteher a file exists """
         return os.path.exists(fname) 
 
     def _iterate_fname(self, fname):
-        """ Iterate until we don't have a name clash """
-        i           = 0
+        """ Iterate until we don't have a name clash, continuing from the last suffix used for the name """
         orig_fn     = fname # basename
+        i           = self.suffixes.get(orig_fn, 0)
         while True:
-            if (fname in self.files) or self.exists(fname):
+            if (fname in self.files) or (fname in self.dirs) or self.exists(fname):
                 i       += 1
                 fname   = orig_fn + ("_%03d" % i)
             else:
                 break
+        self.suffixes[orig_fn]  = i
         return fname
 
+    def in_scratch(self, path=None):
+        """ Check whether a path, by default the base, is in the scratch directory """
+        if path is None:
+            path    = self.base
+        return self.pool['scratch'] != None and path.startswith(self.pool['scratch'])
+
+    def _scratch_fs(self):
+        """ Get the used and the available bytes of the scratch filesystem """
+        st  = os.statvfs(self.pool['scratch'])
+        return (st.f_blocks - st.f_bfree) * st.f_frsize, st.f_bavail * st.f_frsize
+
+    def scratch_used(self):
+        """ Bytes the scratch filesystem grew by since the tree was created, including the
+            unregistered files written by external programs into its directories """
+        return self._scratch_fs()[0] - self.pool['baseline']
+
+    def _has_room(self):
+        """ Check whether the scratch directory is under its budget """
+        if self.pool['budget'] is None:
+            return True
+        return self.scratch_used() < self.pool['budget']
+
+    def _disk_dir(self):
+        """ Get the directory on disk, creating it and its parents on the first spill """
+        if not os.path.isdir(self.disk):
+            self.parent._disk_dir()
+            os.mkdir(self.disk)
+        return self.disk
+
     def tempfile(self, name):
-        """ Get a temporary file """
-        fname       = self._iterate_fname(os.path.join(self.base, name))
+        """ Get a temporary file, spilling to disk once the scratch budget is used up """
+        base    = self.base
+        if self.in_scratch() and not self._has_room():
+            base                    = self._disk_dir()
+            self.pool['spilled']    += 1
+        fname       = self._iterate_fname(os.path.join(base, name))
         self.register(fname)            
         return fname
 
@@ -82,43 +236,72 @@ class Rtemp:
 
     def clean(self):
         """ Remove registered temporary files """
-        for child in self.children:
+        for child in list(self.children):
             child.clean()   # call cleanup on children.
-        tmp = list(self.files)
-        for f in tmp:
+        for f in list(self.files):
             self.remove(f)
         # Delete the directory if children is  a subdir:
         if self.parent != None:
             os.rmdir(self.base)
+            if self.disk != self.base and os.path.isdir(self.disk):
+                os.rmdir(self.disk)
+            self.parent.children.discard(self)
+            self.parent.dirs.discard(self.base)
+            self.parent.dirs.discard(self.disk)
+
+    def purge(self):
+        """ Remove the directories with all their content, including the unregistered files """
+        if os.path.isdir(self.base):
+            shutil.rmtree(self.base, ignore_errors=True)
+        if self.disk != self.base and os.path.isdir(self.disk):
+            shutil.rmtree(self.disk, ignore_errors=True)
 
     def remove(self, fname):
         """ Remove a temporary file """
         if not (fname in self.files):
             self.log.fatal("The file %s is not mannaged by this object!" % fname)
         if os.path.exists(fname):
+            self.pool['removed']    += os.path.getsize(fname)
             os.remove(fname)
-        self.files.remove(fname)
+        self.unregister(fname)
 
     def subdir(self, dname):
-        """ Get a mannaged temporary subdirectory """
+        """ Get a mannaged temporary subdirectory, in the scratch directory while it has room """
         clone           = copy.copy(self)        
-        dname           = os.path.join(self.base, dname)
-        clone_base      = self._iterate_fname(dname)
-        os.mkdir(clone_base)
-        clone.base      = clone_base
+        clone.disk      = self._iterate_fname(os.path.join(self.disk, dname))
+        if self.pool['scratch'] != None and self._has_room():
+            if self.in_scratch():
+                clone.base  = self._iterate_fname(os.path.join(self.base, dname))
+                os.mkdir(clone.base)
+            else:
+                # Subdirectories of the scratch root are shared by concurrent processes:
+                clone.base  = tempfile.mkdtemp(prefix=os.path.basename(clone.disk) + '.', dir=self.pool['scratch'])
+        else:
+            self._disk_dir()
+            clone.base  = clone.disk
+            os.mkdir(clone.base)
         clone.parent    = self
-        clone.children  = []
-        clone.files     = []
-        self.children.append(clone)
+        clone.children  = set()
+        clone.files     = set()
+        clone.dirs      = set()
+        clone.suffixes  = { }
+        self.children.add(clone)
+        self.dirs.update([ clone.base, clone.disk ])
         return clone
 
     def register(self, fname):
         """ Register temporary file """
-        self.files.append(fname)
+        self.files.add(fname)
+        self.pool['files'].add(fname)
     
     def unregister(self, fname):
         """ Unregister temporary file """
         self.files.remove(fname)
+        self.pool['files'].discard(fname)
+
+    def bytes_written(self):
+        """ Bytes in the temporary files of the whole tree so far, the removed ones included """
+        return self.pool['removed'] + sum( os.path.getsize(f) for f in self.pool['files'] if os.path.exists(f) )
 
     def __del__(self):
         if self.autoclean:
@@ -159,14 +342,18 @@ def parse_bl_file(blf):
     return float(file(blf).readlines()[0])
 
 class Res:
-    """ Class for saving results """
-    def __init__(self, f, name):
+    """ Class for saving results, to a file or to a results store """
+    def __init__(self, f, name, store=None):
         self.f      = f
         self.name   = name
+        self.store  = store
 
     def save(self,status,nmut=-10, targ_len=-10, cons_len=-10, seq_ident=-10):
         if status not in (0,-1,-2,-3,-4,-5,-6, -7):
             raise ValueError("Invalid result status: %s" % status)
+        if self.store is not None:
+            self.store.append(self.name, status, nmut, targ_len, cons_len, seq_ident)
+            return
         fh  = open(self.f,"w")
         fh.write("%s\t%d\t%d\t%d\t%d\t%6f\n" %(self.name,status, nmut, targ_len, cons_len, seq_ident) )
         fh.flush()
@@ -174,10 +361,25 @@ class Res:
 
 
 def check_cmd(name):
-    """ Check whether a command is in the path """
+    """ Check whether a command is in the path, once per process """
+    if name in _checked_cmds:
+        return
     cmd = "which %s > /dev/null" % name
     if os.system(cmd) != 0:
         raise ValueError("The command \"%s\" is not present in the path!")
+    _checked_cmds.add(name)
+
+class Lazy:
+    """ Construct an object on the first access to its attributes, so that optional tools are only checked when used """
+    def __init__(self, factory, *args):
+        self._factory   = factory
+        self._args      = args
+        self._obj       = None
+
+    def __getattr__(self, name):
+        if self._obj is None:
+            self._obj   = self._factory(*self._args)
+        return getattr(self._obj, name)
 
 def revcomp(seq):
     """ Reverse complement sequence using Biopython """
@@ -193,34 +395,56 @@ def write_fasta(sequences, fname):
     fh.flush()
     fh.close()
 
-def consensus(aln):
-    """ Calculate majority-rule consensus """
+def consensus(aln, support=False):
+    """ Calculate majority-rule consensus, optionally with the per-column support """
+    nr_seqs = len(aln)
     aln_len = aln.get_alignment_length()
-    cons    = ''
-    for i in xrange(aln_len):
-        counts  = defaultdict(int)
-        col = aln[:, i]
-        for base in col:
-            counts[base] += 1
-        swapped = dict (zip(counts.values(), counts.keys()))
-        char    = swapped[max(swapped.keys())] 
-        if char != '-':
-            cons += char
+    # Load the alignment into a 2-D array of characters:
+    chars   = np.frombuffer(''.join([ str(rec.seq) for rec in aln ]), dtype=np.uint8)
+    chars   = chars.reshape((nr_seqs, aln_len))
+    # Count every symbol in all columns, in tie-breaking order:
+    symbols = sorted(np.unique(chars), key=_cons_rank)
+    counts  = np.array([ np.sum(chars == s, axis=0) for s in symbols ])
+    best    = np.argmax(counts, axis=0)
+    cols    = np.array(symbols, dtype=np.uint8)[best]
+    keep    = cols != ord('-')
+    cons    = cols[keep].tostring()
+    if support:
+        supp    = counts[best, np.arange(aln_len)] / float(nr_seqs)
+        return cons, supp[keep]
     return cons 
 
-def gen_target(ulen, unr):
+def _cons_rank(symbol):
+    """ Tie-breaking rank of consensus symbols: bases in ATGC order, then others, gaps last """
+    c   = chr(symbol)
+    return (c == '-', c not in 'ATGC', 'ATGC'.find(c), c)
+
+def gen_target(ulen, unr, rng=np.random):
     """ Generate a target sequence with unit number and length specified """
     # Generate random unit:  
     alphabet    = ('A','T','G','C')
     unit        = ''
     for i in xrange(ulen):
-        unit += alphabet[ np.random.randint(len(alphabet)) ]
+        unit += alphabet[ rng.randint(len(alphabet)) ]
     # Return sequence:
     return unit * unr
 
+def _load_plotting():
+    """ Import matplotlib with a non-interactive backend """
+    global plt, PdfPages
+    if plt is not None:
+        return
+    import      matplotlib
+    matplotlib.use('Agg')
+    from        matplotlib                      import  pyplot
+    from        matplotlib.backends.backend_pdf import  PdfPages    as  pages
+    plt         = pyplot
+    PdfPages    = pages
+
 class Report:
     """ Class for plotting reports """
     def __init__(self, pdf):
+        _load_plotting()
         self.pdf    = pdf
         self.pages  = PdfPages(pdf)
 
@@ -1,14 +1,20 @@
 import      utils       as      u
 import      os 
-from        Bio         import  SeqIO
+import      time
+import      errno
+import      fcntl
+import      subprocess  as      sp
 import      itertools   as      it
 
 class Velvet:
     """ Assemble reads using velvet """
-    def __init__(self, fqs, kmer_length, min_ctgl, ins_len, max_div, rts, log, clean=False, asm_dir="assembly"):
+    def __init__(self, fqs, kmer_length, min_ctgl, ins_len, max_div, rts, log, clean=False, asm_dir="assembly", fasta=None, reads=None):
         self.log        = log
         self.rts        = rts
         self.fqs        = fqs
+        self.fasta      = fasta
+        # Chunks of interleaved FASTA streamed into velveth instead of a file:
+        self.reads      = reads
         self.kmer_length= kmer_length
         self.min_ctgl   = min_ctgl
         self.ins_len    = ins_len
@@ -21,7 +27,11 @@ class Velvet:
 
     def velveth(self):
         """ Build k-mer hash """
-        self._prepare_fasta()
+        if self.reads is not None:
+            return self._velveth_stream()
+        # Interleave the paired FASTQ files, unless the reads are already in FASTA:
+        if self.fasta is None:
+            self._prepare_fasta()
         cmd = "velveth %s %d -shortPaired -fasta %s >/dev/null" % (self.asm_dir, self.kmer_length, self.fasta)
         if os.system(cmd) != 0:
             return None
@@ -29,16 +39,45 @@ class Velvet:
             self.asm_rts.register(os.path.join(self.asm_dir, f))
         return True
 
+    def _velveth_stream(self):
+        """ Build k-mer hash, writing the reads into a named pipe read by velveth """
+        fifo    = self.rts.tempfile("reads.fifo")
+        os.mkfifo(fifo)
+        devnull = open(os.devnull, 'w')
+        cmd     = [ "velveth", self.asm_dir, str(self.kmer_length), "-shortPaired", "-fasta", fifo ]
+        proc    = sp.Popen(cmd, stdout=devnull)
+        ok      = False
+        try:
+            fh  = _open_fifo(fifo, proc)
+            if fh is not None:
+                try:
+                    for chunk in self.reads:
+                        fh.write(chunk)
+                    ok  = True
+                finally:
+                    try:
+                        fh.close()
+                    except IOError:
+                        # Velveth exited before reading all input.
+                        ok  = False
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+        finally:
+            ret = proc.wait()
+            devnull.close()
+            self.rts.remove(fifo)
+        if not ok or ret != 0:
+            return None
+        for f in ('Log','Roadmaps', 'Sequences'):
+            self.asm_rts.register(os.path.join(self.asm_dir, f))
+        return True
+
     def _prepare_fasta(self):
         """ Prepare input for velveth """
         output   = self.rts.tempfile("reads.fas")
         ofh      = open(output, 'w')
-        stream1  = SeqIO.parse(self.fqs[0],'fastq')
-        stream2  = SeqIO.parse(self.fqs[1],'fastq')
-
-        for record in it.chain( it.izip(stream1, stream2) ):
-            SeqIO.write(record, ofh, 'fasta')    
-
+        interleave_fastq(self.fqs[0], self.fqs[1], ofh, self.log)
         ofh.flush()
         ofh.close()
         self.fasta  = output
@@ -63,3 +102,45 @@ class Velvet:
             return None
         return contigs
 
+def _open_fifo(fifo, proc, poll=0.05):
+    """ Open a named pipe for writing once the reader process opened it, None if the reader exited first """
+    while True:
+        try:
+            fd  = os.open(fifo, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+            if proc.poll() is not None:
+                return None
+            time.sleep(poll)
+    # Writes block again once the pipe is open:
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    return os.fdopen(fd, 'w')
+
+def interleave_fastq(fq1, fq2, ofh, log, block_size=100000):
+    """ Write paired four-line FASTQ files as interleaved FASTA, in blocks of raw lines """
+    for chunk in iter_interleaved(fq1, fq2, log, block_size):
+        ofh.write(chunk)
+
+def iter_interleaved(fq1, fq2, log, block_size=100000):
+    """ Iterate over paired four-line FASTQ files as chunks of interleaved FASTA """
+    fh1      = open(fq1, 'r')
+    fh2      = open(fq2, 'r')
+    while True:
+        lines1  = list(it.islice(fh1, 4 * block_size))
+        lines2  = list(it.islice(fh2, 4 * block_size))
+        if len(lines1) != len(lines2) or len(lines1) % 4 != 0:
+            log.fatal("The paired FASTQ files are not in sync!")
+        if len(lines1) == 0:
+            break
+        if not (lines1[2].startswith('+') and lines2[2].startswith('+')):
+            log.fatal("Multi-line FASTQ records are not supported!")
+        out         = [ None ] * len(lines1)
+        out[0::4]   = [ '>' + h[1:] for h in lines1[0::4] ]
+        out[1::4]   = lines1[1::4]
+        out[2::4]   = [ '>' + h[1:] for h in lines2[0::4] ]
+        out[3::4]   = lines2[1::4]
+        yield ''.join(out)
+    fh1.close()
+    fh2.close()
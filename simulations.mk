@@ -2,10 +2,11 @@
 # Simulations Makefile
 #
 
-.PHONY:	seq_sim dil_sim
+.PHONY:	seq_sim seq_sim_pcr_cache seq_sim_cached dil_sim dil_sim_forked dil_sim_adaptive
 
 # General parameters:
 LSF_QUEUE		= research-rh6
+EXECUTOR_ARGS	= -E lsf -Q $(LSF_QUEUE)	# Use "-E local [-j nr_workers] [-Mb mem_budget_mb]" to run on this machine, add "-W wall_time_s [-p nr_procs]" to pack experiments into jobs.
 
 SIMNGS_RUNFILE  =$(BASE)/dat/s_8_4x.runfile
 READ_LENGTH     =101
@@ -23,6 +24,8 @@ VMIN_CTGL       = 400
 VKMER_LENGTH    = 90
 VMAX_DIV        = 0.1
 TOTAL_COV       = 4000
+PCR_BACKEND     = R			# PCR simulation backend: R (pcr_coal.R) or numpy (in-process).
+SIM_METHODS     = -pb $(PCR_BACKEND)	# Add "-rs native -so kmer -ac band -ma star -me vector" for the in-process read simulation, strand voting, comparison, star alignment and vectorized substitutions.
 
 # seq_sim specific parameters:
 SEQ_OUT_DIR		=$(BASE)/seq_sim/out
@@ -32,14 +35,25 @@ UNIT_NR_RANGE	= 4:100:4		# Unit number range and step size.
 UNIT_LEN_RANGE	= 4:4000:5		# Unit length range and step size.
 MIN_TLEN		= 500			# Minimum target sequence length.
 MAX_TLEN		= 30000			# Maximum target sequence length.
+PCR_CACHE_DIR	= $(BASE)/seq_sim/pcr_cache	# Store of the precomputed PCR genealogies.
+PCR_CACHE_DRAWS	= $(NR_REPS)				# Number of precomputed genealogies, one per replicate.
 
 SEQ_SIM_PARAMS  = "-n $(MUT_MODEL_FILE) -b $(BL_SCALER_FILE) -i $(INIT_POPSIZE) -e $(PCR_EFFICIENCY) -cm $(CYCLES_MUT) -dm $(DILF_MUT)  \
 -cc $(CYCLES_CLEAN) -dc $(DILF_CLEAN) -cf $(CYCLES_FINAL) -ss $(SAMPLE_SIZE) -vm $(VMIN_CTGL) -vk $(VKMER_LENGTH) -vi $(INSERT_SIZE) \
--vd $(VMAX_DIV) -P $(BIN) -S $(SIMNGS_RUNFILE) -L $(READ_LENGTH) -I $(INSERT_SIZE) -t $(TOTAL_COV)"
+-vd $(VMAX_DIV) -P $(BIN) -S $(SIMNGS_RUNFILE) -L $(READ_LENGTH) -I $(INSERT_SIZE) -t $(TOTAL_COV) $(SIM_METHODS)"
 
 # Simulate NG-SAM experiments on random targets with varying repetitive structure:
 seq_sim:
-	@bin/run_seq_sim -m $(MIN_TLEN) -M $(MAX_TLEN) -Q $(LSF_QUEUE) -X '$(SEQ_SIM_PARAMS)' -R $(RUN_DIR) -T $(SEQ_TARGET_DIR) -n $(NR_REPS) -u $(UNIT_NR_RANGE) -l $(UNIT_LEN_RANGE) -o $(SEQ_OUT_DIR)
+	@bin/run_seq_sim -m $(MIN_TLEN) -M $(MAX_TLEN) $(EXECUTOR_ARGS) -X '$(SEQ_SIM_PARAMS)' -R $(RUN_DIR) -T $(SEQ_TARGET_DIR) -n $(NR_REPS) -u $(UNIT_NR_RANGE) -l $(UNIT_LEN_RANGE) -o $(SEQ_OUT_DIR)
+
+# Precompute PCR genealogies shared by the seq_sim targets:
+seq_sim_pcr_cache:
+	@mkdir -p $(PCR_CACHE_DIR)
+	@bin/gen_pcr_cache -i $(INIT_POPSIZE) -e $(PCR_EFFICIENCY) -cm $(CYCLES_MUT) -dm $(DILF_MUT) -cc $(CYCLES_CLEAN) -dc $(DILF_CLEAN) -cf $(CYCLES_FINAL) -ss $(SAMPLE_SIZE) -pb $(PCR_BACKEND) -g $(PCR_CACHE_DRAWS) -C $(PCR_CACHE_DIR)
+
+# Simulate seq_sim experiments using the precomputed PCR genealogies:
+seq_sim_cached: seq_sim_pcr_cache
+	@bin/run_seq_sim -m $(MIN_TLEN) -M $(MAX_TLEN) $(EXECUTOR_ARGS) -X '$(SEQ_SIM_PARAMS)' -R $(RUN_DIR) -T $(SEQ_TARGET_DIR) -n $(NR_REPS) -u $(UNIT_NR_RANGE) -l $(UNIT_LEN_RANGE) -o $(SEQ_OUT_DIR) -G $(PCR_CACHE_DIR)
 
 # Visualise the results of seq_sim:
 plot_seq_res:
@@ -52,14 +66,24 @@ NR_REPS			= 5							# Number of replications for a given dm/dc combination.
 D1_RANGE		= 17000:280000:20000		# First dilution range.
 D2_RANGE		= 2000000:128000000:200000	# Second dilution range.
 DIL_TARGET		= $(BASE)/dat/eater_root.fas
+DIL_STATE_DIR	= $(BASE)/dil_sim/states		# Saved PCR stages shared between grid cells.
+DIL_BUDGET		= 4000						# Total number of experiments of dil_sim_adaptive.
 
 DIL_SIM_PARAMS  = "-n $(MUT_MODEL_FILE) -b $(BL_SCALER_FILE) -i $(INIT_POPSIZE) -e $(PCR_EFFICIENCY) -cm $(CYCLES_MUT) \
 -cc $(CYCLES_CLEAN) -cf $(CYCLES_FINAL) -ss $(SAMPLE_SIZE) -vm $(VMIN_CTGL) -vk $(VKMER_LENGTH) -vi $(INSERT_SIZE) \
--vd $(VMAX_DIV) -P $(BIN) -S $(SIMNGS_RUNFILE) -L $(READ_LENGTH) -I $(INSERT_SIZE) -t $(TOTAL_COV)"
+-vd $(VMAX_DIV) -P $(BIN) -S $(SIMNGS_RUNFILE) -L $(READ_LENGTH) -I $(INSERT_SIZE) -t $(TOTAL_COV) $(SIM_METHODS)"
 
 # Simulate NG-SAM experiments under a range of dilution factors.
 dil_sim:
-	@bin/run_dil_sim -t $(DIL_TARGET) -m $(MIN_TLEN) -M $(MAX_TLEN) -Q $(LSF_QUEUE) -X '$(DIL_SIM_PARAMS)' -R $(RUN_DIR) -n $(NR_REPS) -o $(DIL_OUT_DIR) -d1 $(D1_RANGE) -d2 $(D2_RANGE)
+	@bin/run_dil_sim -t $(DIL_TARGET) -m $(MIN_TLEN) -M $(MAX_TLEN) $(EXECUTOR_ARGS) -X '$(DIL_SIM_PARAMS)' -R $(RUN_DIR) -n $(NR_REPS) -o $(DIL_OUT_DIR) -d1 $(D1_RANGE) -d2 $(D2_RANGE)
+
+# Simulate dil_sim forking the grid cells from shared mutagenic and cleanup PCR stages:
+dil_sim_forked:
+	@bin/run_dil_sim -t $(DIL_TARGET) -m $(MIN_TLEN) -M $(MAX_TLEN) $(EXECUTOR_ARGS) -X '$(DIL_SIM_PARAMS)' -R $(RUN_DIR) -n $(NR_REPS) -o $(DIL_OUT_DIR) -d1 $(D1_RANGE) -d2 $(D2_RANGE) -F $(DIL_STATE_DIR)
+
+# Simulate dil_sim refining a coarse grid where the results change sharply or are uncertain:
+dil_sim_adaptive:
+	@bin/run_dil_sim -t $(DIL_TARGET) -m $(MIN_TLEN) -M $(MAX_TLEN) $(EXECUTOR_ARGS) -X '$(DIL_SIM_PARAMS)' -R $(RUN_DIR) -n $(NR_REPS) -o $(DIL_OUT_DIR) -d1 $(D1_RANGE) -d2 $(D2_RANGE) -A $(DIL_BUDGET)
 
 # Visualise the results of dil_sim:
 plot_dil_res: